@@ -36,61 +36,40 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # 
 
-# Import the class
+from __future__ import print_function
+
+# Import the classes
 import zeemote_listener as zl
+import zeemote_events as ze
 
 #debug = zl.debug
 debug = True
 
 
+def say(message):
+    def callback(arg):
+        if debug:
+            print("**** " + message)
+    return callback
+
+
 def listening_zeemote():
-    moving_X = False
-    moving_Y = False
+    dispatcher = ze.EventDispatcher()
 
-    while True:
-        # Waiting for a packet to be received
-        packet = zeemote.listen()
+    # Joystick movements: called once when the joystick starts pointing
+    # to a direction, not on every report
+    dispatcher.on_direction(ze.LEFT, on_enter=say("Moving to the left"))
+    dispatcher.on_direction(ze.RIGHT, on_enter=say("Moving to the right"))
+    dispatcher.on_direction(ze.UP, on_enter=say("Moving up"))
+    dispatcher.on_direction(ze.DOWN, on_enter=say("Moving down"))
 
-        # If we receive something
-        if packet:
-            # Now we can check to the ID we want
-            # ID 0x08, joystick movement
-            if packet['Report ID'] == "\x08":
-                if not moving_X:
-                    if packet['X-Axis Reading'] >= "\x80" and packet['X-Axis Reading'] != "\x00":
-                        if debug:
-                            print "**** Moving to the left"
-                    elif packet['X-Axis Reading'] < "\x80" and packet['X-Axis Reading'] != "\x00":
-                        if debug:
-                            print "**** Moving to the right"
-                    moving_X = True
-                else:
-                    if packet['X-Axis Reading'] == "\x00":
-                        moving_X = False
+    # Buttons: an application would emit its own signals here
+    dispatcher.on_press(0x00, say("Button A"))
+    dispatcher.on_press(0x01, say("Button B"))
+    dispatcher.on_press(0x02, say("Button C"))
 
-                if not moving_Y:
-                    if packet['Y-Axis Reading'] >= "\x80" and packet['Y-Axis Reading'] != "\x00":
-                        if debug:
-                            print "**** Moving up"
-                    elif packet['Y-Axis Reading'] < "\x80" and packet['Y-Axis Reading'] != "\x00":
-                        if debug:
-                            print "**** Moving down"
-                    moving_Y = True
-                else:
-                    if packet['Y-Axis Reading'] == "\x00":
-                        moving_Y = False
-            # ID 0x07, button pressed
-            elif packet['Report ID'] == "\x07":
-                if packet['Key Code 1'] == "\x00":
-                    if debug:
-                        print "**** Button A"
-                    emit_ButtonA_signal(obj)
-                elif packet['Key Code 1'] == "\x01":
-                    if debug:
-                        print "**** Button B"
-                elif packet['Key Code 1'] == "\x02":
-                    if debug:
-                        print "**** Button C"
+    # Waiting for packets and calling the callbacks
+    dispatcher.run(zeemote)
 
 
 # Object creation
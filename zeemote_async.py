@@ -0,0 +1,231 @@
+#!/usr/bin/python3
+
+# 
+# LICENSE
+# 
+# Copyright (c) 2010, University College Dublin, National University of
+# Ireland, Dublin
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# - Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# 
+# - Neither the name University College Dublin, National University of
+# Ireland, Dublin nor the names of its contributors may be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# asyncio client for the Zeemote controllers.  This module needs Python 3,
+# the blocking ZeemoteControl of zeemote_listener works with both.
+#
+
+import asyncio
+import socket
+
+import zeemote_listener as zl
+
+
+class AsyncZeemoteControl():
+    """Zeemote client running on the asyncio event loop.
+
+    The RFCOMM socket is non-blocking and read by a task of the loop, which
+    decodes reports into a queue and matches handshakes with the commands
+    waiting for them:
+
+        zeemote = AsyncZeemoteControl()
+        await zeemote.connect()
+        await zeemote.set_idle(b"\\x00")
+        async for report in zeemote:
+            ...
+    """
+    def __init__(self, address=None, port=None, tries_nb=3, handshake_timeout=1.0):
+        self.address = address
+        self.port = port
+        self.number_of_tries = tries_nb
+        self.handshake_timeout = handshake_timeout
+
+        self.connected = False
+        self.sock = None
+        self.parser = None
+        self.reports = None
+        self.reader_task = None
+
+    def discover(self):
+        service_matches = []
+        while self.number_of_tries > 0 and len(service_matches) == 0:
+            self.number_of_tries -= 1
+            service_matches = zl.find_service(uuid=zl.ZEEMOTE_UUID, address=self.address)
+
+        if len(service_matches) == 0:
+            raise zl.BluetoothError("No zeemote device found")
+
+        self.address = service_matches[0]["host"]
+        self.port = service_matches[0]["port"]
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        # The port of a known address is looked up too
+        if self.port is None:
+            if zl.debug:
+                print("Trying to find a Zeemote device...")
+            # SDP inquiries are blocking
+            await loop.run_in_executor(None, self.discover)
+
+        sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, (self.address, self.port))
+        except:
+            sock.close()
+            raise
+
+        self.sock = sock
+        self.parser = zl.ZcpParser()
+        self.reports = asyncio.Queue()
+        self.connected = True
+        self.reader_task = loop.create_task(self.read_loop())
+        if zl.debug:
+            print("Connected to %s (%d)" % (self.address, self.port))
+
+    async def disconnect(self):
+        # read_loop() may already have ended on its own, with the socket
+        # still open
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            try:
+                await self.reader_task
+            except asyncio.CancelledError:
+                pass
+            self.reader_task = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            if zl.debug:
+                print("Disconnected from the Zeemote controller")
+
+    async def read_loop(self):
+        loop = asyncio.get_running_loop()
+        end = None
+        try:
+            while True:
+                n = await loop.sock_recv_into(self.sock, self.parser.writable())
+                if n == 0:
+                    break
+                self.parser.written(n)
+
+                # Handshakes complete the commands waiting for them
+                frame = self.parser.next_frame()
+                while frame is not None:
+                    self.reports.put_nowait(zl.decode_report(frame))
+                    frame = self.parser.next_frame()
+        except zl.LengthPacketException as e:
+            end = e
+        except OSError:
+            pass
+        finally:
+            self.connected = False
+            self.parser.fail(ConnectionError("Zeemote connection closed"))
+            # Wake up the consumers
+            self.reports.put_nowait(end)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        report = await self.reports.get()
+        if report is None or isinstance(report, Exception):
+            # Let the next consumer see the end of the stream too
+            self.reports.put_nowait(None)
+            if report is None:
+                raise StopAsyncIteration
+            raise report
+        return report
+
+    async def listen(self):
+        """Return the next report, or None once the connection is closed."""
+        try:
+            return await self.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    async def listen_many(self, max_n=64, timeout=None):
+        """Return up to max_n reports, waiting at most timeout for the first."""
+        try:
+            first = await asyncio.wait_for(self.listen(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        if first is None:
+            return []
+
+        reports = [first]
+        while len(reports) < max_n and not self.reports.empty():
+            report = self.reports.get_nowait()
+            if report is None or isinstance(report, Exception):
+                self.reports.put_nowait(report)
+                break
+            reports.append(report)
+        return reports
+
+    async def command(self, msg):
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self.parser.expect(waiter)
+        await loop.sock_sendall(self.sock, msg)
+        # On timeout the waiter is cancelled, and skipped by the parser
+        return await asyncio.wait_for(waiter, self.handshake_timeout)
+
+    async def set_idle(self, time):
+        idle_msg = zl.idle_message(time)
+        if idle_msg is None:
+            return zl.ZeemoteControl.HANDSHAKE_ERR_INVALID_PARAMETER
+
+        return await self.command(idle_msg)
+
+    async def set_report_type_enable(self, report_id, enable=1, raw=0, reserved=0):
+        report_msg = zl.report_type_enable_message(report_id, enable, raw, reserved)
+        if report_msg is None:
+            return zl.ZeemoteControl.HANDSHAKE_ERR_INVALID_PARAMETER
+
+        return await self.command(report_msg)
+
+    async def set_device_local_name(self, name="Zeemote"):
+        name_msg = zl.device_local_name_message(name)
+        if name_msg is None:
+            return zl.ZeemoteControl.HANDSHAKE_ERR_INVALID_PARAMETER
+
+        # The device may silently ignore this one
+        try:
+            return await self.command(name_msg)
+        except asyncio.TimeoutError:
+            return None
+
+    async def set_keep_alive_interval(self, interval):
+        interval_msg = zl.keep_alive_interval_message(interval)
+        if interval_msg is None:
+            return zl.ZeemoteControl.HANDSHAKE_ERR_INVALID_PARAMETER
+
+        return await self.command(interval_msg)
+
+    # End of the class AsyncZeemoteControl
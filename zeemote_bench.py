@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+
+# 
+# LICENSE
+# 
+# Copyright (c) 2010, University College Dublin, National University of
+# Ireland, Dublin
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# - Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# 
+# - Neither the name University College Dublin, National University of
+# Ireland, Dublin nor the names of its contributors may be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# Benchmarks of the report decoding: throughput, per report latency and
+# memory, printed as JSON to be compared with a stored baseline
+#
+
+from __future__ import print_function
+
+import argparse
+import gc
+import itertools
+import json
+import platform
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+import zeemote_capture as zc
+import zeemote_listener as zl
+import zeemote_simulator as zs
+
+timer = getattr(time, "perf_counter", time.time)
+
+
+#
+# Workloads
+#
+def joystick_frames(n):
+    reports = (r for r in zs.synthetic_reports(0) if r.report_id in (0x08, 0x09, 0x0A))
+    return [zl.encode_report(r) for r in itertools.islice(reports, n)]
+
+def button_frames(n):
+    frames = []
+    keys = [zl.KEY_NONE] * 6
+    for i in range(n):
+        # Press up to 6 keys one after the other, then release them all
+        slot = i % 7
+        if slot < 6:
+            keys[slot] = slot
+        else:
+            keys = [zl.KEY_NONE] * 6
+        frames.append(zl.encode_report(zl.KeyReport(0x07, tuple(keys))))
+    return frames
+
+def device_info_frames(n):
+    info = [zl.encode_report(zl.FirmwareReport(0x03, 1, 2, 3, 4, 5, b"Zeemote JS1"))]
+    for button in range(4):
+        info.append(zl.encode_report(zl.ButtonDescriptionReport(0x04, button, button, b"Button " + b"ABCD"[button:button + 1])))
+    info.append(zl.encode_report(zl.ProtocolVersionReport(0x1B, 1, 2, 0)))
+    return list(itertools.islice(itertools.cycle(info), n))
+
+def mixed_frames(n):
+    return [zl.encode_report(r) for r in itertools.islice(zs.synthetic_reports(0), n)]
+
+def stream_frames(path, n):
+    """Input report frames of a capture file or of a raw ZCP stream,
+    cycled up to n."""
+    with open(path, "rb") as f:
+        data = f.read()
+
+    frames = []
+    if data.startswith(zc.MAGIC):
+        reader = zc.CaptureReader(path)
+        frames = [frame.data for frame in reader.frames(direction=zc.INPUT)
+                  if ord(frame.data[1:2]) == zl.HEADER_DATA_INPUT]
+        reader.close()
+        data = b""
+
+    parser = zl.ZcpParser()
+    for i in range(0, len(data), 256):
+        chunk = data[i:i + 256]
+        parser.writable()[:len(chunk)] = chunk
+        parser.written(len(chunk))
+        frame = parser.next_frame()
+        while frame is not None:
+            if len(frame) > 2 and ord(frame[1:2]) == zl.HEADER_DATA_INPUT:
+                frames.append(frame)
+            frame = parser.next_frame()
+    return list(itertools.islice(itertools.cycle(frames), n))
+
+WORKLOADS = {
+    "joystick": joystick_frames,
+    "buttons": button_frames,
+    "device-info": device_info_frames,
+    "mixed": mixed_frames,
+}
+
+
+#
+# Measures
+#
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def measure_throughput(frames, repeat):
+    """Frames per second decoded by ZcpParser.feed(), best of repeat."""
+    stream = b"".join(frames)
+    chunks = [stream[i:i + 4096] for i in range(0, len(stream), 4096)]
+    best = None
+    for i in range(repeat):
+        parser = zl.ZcpParser()
+        start = timer()
+        for chunk in chunks:
+            parser.feed(chunk)
+        elapsed = timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(frames) / best
+
+def measure_latency(frames):
+    """Decode time of each frame, in microseconds, per report ID."""
+    samples = {}
+    decode = zl.decode_report
+    for frame in frames:
+        start = timer()
+        decode(frame)
+        elapsed = timer() - start
+        samples.setdefault(ord(frame[2:3]), []).append(elapsed * 1e6)
+
+    latency = {}
+    for report_id, values in sorted(samples.items()):
+        values.sort()
+        latency["0x%02X" % report_id] = {
+            "count": len(values),
+            "p50": percentile(values, 50),
+            "p90": percentile(values, 90),
+            "p99": percentile(values, 99),
+            "max": values[-1],
+        }
+    return latency
+
+def measure_memory(frames):
+    """Memory still held per decoded report (the reports themselves, kept
+    alive during the measure) in blocks and bytes, and peak traced memory.
+
+    These count what is retained, not the temporary allocations made
+    while decoding, which are freed before the end.
+    """
+    gc.collect()
+    result = {"retained_blocks_per_frame": None, "retained_bytes_per_frame": None, "peak_bytes": None}
+    getallocatedblocks = getattr(sys, "getallocatedblocks", None)
+    if tracemalloc is not None:
+        tracemalloc.start()
+        snapshot = tracemalloc.take_snapshot()
+    before = getallocatedblocks() if getallocatedblocks else 0
+
+    reports = zl.ZcpParser().feed(b"".join(frames))
+
+    if getallocatedblocks:
+        result["retained_blocks_per_frame"] = (getallocatedblocks() - before) / float(len(reports))
+    if tracemalloc is not None:
+        result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        retained = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(snapshot, "filename"))
+        result["retained_bytes_per_frame"] = retained / float(len(reports))
+        tracemalloc.stop()
+    return result
+
+def measure_client(n):
+    """Reports per second through ZeemoteControl and a simulated device."""
+    transport, simulator = zs.simulated_transport(rate=0, burst=64, drop_after=n)
+    zeemote = zl.ZeemoteControl()
+    zeemote.connect(transport=transport)
+    received = 0
+    start = timer()
+    while zeemote.connected:
+        received += len(zeemote.listen_many(256, 1))
+    elapsed = timer() - start
+    simulator.thread.join()
+    return received / elapsed
+
+def run(names, n, repeat, stream=None):
+    results = {
+        "python": platform.python_version(),
+        "frames": n,
+        "workloads": {},
+    }
+    workloads = [(name, WORKLOADS[name](n)) for name in names]
+    if stream:
+        workloads.append(("stream", stream_frames(stream, n)))
+
+    for name, frames in workloads:
+        results["workloads"][name] = {
+            "frames_per_second": measure_throughput(frames, repeat),
+            "latency_us": measure_latency(frames),
+            "memory": measure_memory(frames),
+        }
+    results["client_reports_per_second"] = measure_client(n)
+    if resource is not None:
+        results["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+def compare(results, baseline, tolerance):
+    """Print the throughput changes, return False on a regression."""
+    ok = True
+    for name, current in sorted(results["workloads"].items()):
+        previous = baseline.get("workloads", {}).get(name)
+        if previous is None:
+            continue
+        change = current["frames_per_second"] / previous["frames_per_second"] - 1
+        print("%-12s %12.0f frames/s %+7.1f%%" % (name, current["frames_per_second"], change * 100), file=sys.stderr)
+        if change < -tolerance:
+            ok = False
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ZCP report decoding")
+    parser.add_argument("--workload", action="append", choices=sorted(WORKLOADS),
+                        help="workload to run, may be repeated (default: all)")
+    parser.add_argument("--stream", metavar="FILE",
+                        help="also benchmark the frames of a capture file or raw ZCP stream")
+    parser.add_argument("--frames", type=int, default=100000, help="frames per workload")
+    parser.add_argument("--repeat", type=int, default=5, help="throughput runs, best is kept")
+    parser.add_argument("--output", metavar="FILE", help="write the JSON results there")
+    parser.add_argument("--baseline", metavar="FILE", help="JSON results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="throughput loss tolerated against the baseline (default: 0.10)")
+    args = parser.parse_args()
+
+    zl.debug = False
+    # Keep the connection messages of the library out of the JSON
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        results = run(args.workload or sorted(WORKLOADS), args.frames, args.repeat, args.stream)
+    finally:
+        sys.stdout = stdout
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
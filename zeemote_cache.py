@@ -0,0 +1,154 @@
+#!/usr/bin/python
+
+# 
+# LICENSE
+# 
+# Copyright (c) 2010, University College Dublin, National University of
+# Ireland, Dublin
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# - Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# 
+# - Neither the name University College Dublin, National University of
+# Ireland, Dublin nor the names of its contributors may be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# On-disk caches: the RFCOMM endpoints of the Zeemote devices, so that
+# connecting again doesn't need an SDP inquiry, and the information
+# reports of the devices, so that they are asked only once
+#
+
+from binascii import hexlify, unhexlify
+import json
+import os
+import time
+
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "pyzeemote")
+
+
+class JsonCache():
+    """Entries kept in a JSON file, rewritten atomically on each change.
+
+    Errors reading or writing the file are not fatal: the cache is then
+    just empty, or not saved.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if isinstance(entries, dict):
+            self.entries = entries
+
+    def save(self):
+        tmp = "%s.%d" % (self.path, os.getpid())
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            pass
+
+    def forget(self, address):
+        if self.entries.pop(address, None) is not None:
+            self.save()
+
+    def clear(self):
+        self.entries = {}
+        self.save()
+
+    # End of the class JsonCache
+
+
+class ServiceCache(JsonCache):
+    """(address, port, name) of the devices found by SDP, with the time
+    they were last seen.  Entries older than ttl seconds are ignored.
+    """
+    def __init__(self, path=None, ttl=7 * 24 * 3600):
+        self.ttl = ttl
+        # address -> [port, name, time]
+        JsonCache.__init__(self, path or os.path.join(CACHE_DIR, "services.json"))
+
+    def get(self, address=None):
+        """Return the fresh endpoints of address (of every device if None),
+        the most recently seen first."""
+        now = time.time()
+        endpoints = []
+        for host, entry in self.entries.items():
+            try:
+                port, name, seen = entry
+                fresh = now - seen < self.ttl
+            except (TypeError, ValueError):
+                # Not written by put(): skipped
+                continue
+            if (address is None or host == address) and fresh:
+                endpoints.append((seen, host, port, name))
+        endpoints.sort(reverse=True)
+        return [(host, port, name) for seen, host, port, name in endpoints]
+
+    def put(self, address, port, name=None):
+        self.entries[address] = [port, name, time.time()]
+        self.save()
+
+    # End of the class ServiceCache
+
+
+class DeviceInfoCache(JsonCache):
+    """Frames of the device information reports of each device, valid as
+    long as the device sends the same firmware report."""
+    def __init__(self, path=None):
+        # address -> {"firmware": hex frame, "reports": [hex frames]}
+        JsonCache.__init__(self, path or os.path.join(CACHE_DIR, "devices.json"))
+
+    def get(self, address, firmware):
+        """Return the frames cached for address with this firmware frame,
+        or None."""
+        entry = self.entries.get(address)
+        if not isinstance(entry, dict) or entry.get("firmware") != hexlify(firmware).decode("ascii"):
+            return None
+        try:
+            return [unhexlify(frame) for frame in entry["reports"]]
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def put(self, address, firmware, frames):
+        self.entries[address] = {
+            "firmware": hexlify(firmware).decode("ascii"),
+            "reports": [hexlify(frame).decode("ascii") for frame in frames],
+        }
+        self.save()
+
+    # End of the class DeviceInfoCache
@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+
+# 
+# LICENSE
+# 
+# Copyright (c) 2010, University College Dublin, National University of
+# Ireland, Dublin
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# - Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# 
+# - Neither the name University College Dublin, National University of
+# Ireland, Dublin nor the names of its contributors may be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# Capture files: every frame exchanged with the devices, timestamped, with
+# an index to replay them from any point
+#
+# Layout (little-endian):
+#   header   "ZCAP", version (H), reserved (H), wall clock start time (d)
+#   records  seconds since start (d), device (H), direction (B), size (H),
+#            then the frame itself
+#   footer   device names (H length + UTF-8 name each), record offsets (Q
+#            each), then the trailer: devices offset (Q), device count (I),
+#            index offset (Q), record count (Q), "ZIDX"
+#
+# The footer is written by close(); without it, the reader rebuilds the
+# index by walking through the records.
+#
+
+from __future__ import print_function
+
+import argparse
+import errno
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+try:
+    from queue import Queue, Full, Empty
+except ImportError:
+    # Python 2
+    from Queue import Queue, Full, Empty
+
+from zeemote_transport import Transport
+
+monotonic = getattr(time, "monotonic", time.time)
+
+MAGIC = b"ZCAP"
+VERSION = 1
+HEADER = struct.Struct("<4sHHd")
+RECORD = struct.Struct("<dHBH")
+OFFSET = struct.Struct("<Q")
+TRAILER = struct.Struct("<QIQQ4s")
+TRAILER_MAGIC = b"ZIDX"
+
+# Directions
+INPUT = 0   # device -> host
+OUTPUT = 1  # host -> device
+
+
+CapturedFrame = namedtuple('CapturedFrame', 'timestamp device direction data')
+
+# prefix -> TraceWriter shared by several users, see shared_trace()
+shared_traces = {}
+shared_lock = threading.Lock()
+
+
+class CaptureWriter():
+    """Append frames to a capture file.
+
+    With exclusive, the file must not exist yet (OSError with EEXIST
+    otherwise): an existing capture is never truncated.
+    """
+    def __init__(self, path, exclusive=False):
+        if exclusive:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            self.file = os.fdopen(fd, "wb")
+        else:
+            self.file = open(path, "wb")
+        self.start = monotonic()
+        self.file.write(HEADER.pack(MAGIC, VERSION, 0, time.time()))
+        self.offset = HEADER.size
+        self.offsets = []
+        self.devices = []
+
+    def add_device(self, name):
+        """Return the number identifying a device in the capture."""
+        if name not in self.devices:
+            self.devices.append(name)
+        return self.devices.index(name)
+
+    def write(self, direction, frame, device=0, timestamp=None):
+        if timestamp is None:
+            timestamp = monotonic()
+        self.write_many([(timestamp, device, direction, frame)])
+
+    def write_many(self, records):
+        """Write (timestamp, device, direction, frame) records at once."""
+        chunks = []
+        for timestamp, device, direction, frame in records:
+            chunks.append(RECORD.pack(timestamp - self.start, device, direction, len(frame)))
+            chunks.append(frame)
+            self.offsets.append(self.offset)
+            self.offset += RECORD.size + len(frame)
+        self.file.write(b"".join(chunks))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file is None:
+            return
+        devices_offset = self.offset
+        for name in self.devices:
+            name = name.encode("utf-8")
+            self.file.write(struct.pack("<H", len(name)) + name)
+        index_offset = self.file.tell()
+        self.file.write(b"".join(OFFSET.pack(offset) for offset in self.offsets))
+        self.file.write(TRAILER.pack(devices_offset, len(self.devices), index_offset,
+                                     len(self.offsets), TRAILER_MAGIC))
+        self.file.close()
+        self.file = None
+
+    # End of the class CaptureWriter
+
+
+class TraceWriter():
+    """CaptureWriter working in a background thread.
+
+    write() only timestamps the frame and hands it to the writer thread
+    through a bounded queue, it never blocks: when the queue is full, the
+    frame is counted in dropped instead.  The thread writes the frames in
+    batches, with one flush per batch.
+    """
+    def __init__(self, path, maxsize=4096, batch=256, exclusive=False):
+        self.path = path
+        self.capture = CaptureWriter(path, exclusive)
+        self.devices = self.capture.devices
+        self.queue = Queue(maxsize)
+        self.batch = batch
+        self.dropped = 0
+        # Number of shared_trace() callers which haven't closed it yet, and
+        # the prefix it is shared under
+        self.users = 0
+        self.prefix = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add_device(self, name):
+        with shared_lock:
+            return self.capture.add_device(name)
+
+    def write(self, direction, frame, device=0, timestamp=None):
+        if timestamp is None:
+            timestamp = monotonic()
+        try:
+            self.queue.put_nowait((timestamp, device, direction, frame))
+        except Full:
+            self.dropped += 1
+
+    def flush(self):
+        # Batches are flushed by the writer thread
+        pass
+
+    def run(self):
+        running = True
+        while running:
+            records = [self.queue.get()]
+            while len(records) < self.batch:
+                try:
+                    records.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            if records[-1] is None:
+                # close() was called
+                records.pop()
+                running = False
+            self.capture.write_many(records)
+            self.capture.flush()
+
+    def close(self):
+        with shared_lock:
+            if self.users > 1:
+                # Still written by other users
+                self.users -= 1
+                return
+            self.users = 0
+            if shared_traces.get(self.prefix) is self:
+                del shared_traces[self.prefix]
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.capture.close()
+
+    # End of the class TraceWriter
+
+
+def shared_trace(prefix):
+    """Return the TraceWriter shared under prefix, opened by the first call.
+
+    Every caller gets the same writer, so that the devices of a process
+    are recorded in one capture, and closes it once done: the capture is
+    completed by the last close().  The writer opened after that one is
+    closed goes to a new file: the captures are PREFIX-N.zcap, N being
+    the first number whose file doesn't exist.
+    """
+    with shared_lock:
+        trace = shared_traces.get(prefix)
+        if trace is None:
+            number = 0
+            while trace is None:
+                try:
+                    trace = TraceWriter("%s-%d.zcap" % (prefix, number), exclusive=True)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                    number += 1
+            trace.prefix = prefix
+            shared_traces[prefix] = trace
+        trace.users += 1
+        return trace
+
+
+class CaptureReader():
+    """Random access to the frames of a capture file, through mmap."""
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, reserved, self.wall_start = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a capture file" % path)
+
+        self.devices = []
+        self.offsets = None
+        self.end = len(self.map)
+        if not self.read_footer():
+            self.devices = []
+            self.end = len(self.map)
+            self.offsets = self.scan()
+
+    def read_footer(self):
+        """Load the device names and the index written by close().
+
+        Return False when there is no footer, or when its offsets don't
+        fit in the file (capture overwritten or cut while being read).
+        """
+        size = len(self.map)
+        if size < HEADER.size + TRAILER.size:
+            return False
+        devices_offset, device_count, index_offset, count, trailer_magic = \
+            TRAILER.unpack_from(self.map, size - TRAILER.size)
+        if trailer_magic != TRAILER_MAGIC:
+            return False
+        if not HEADER.size <= devices_offset <= index_offset:
+            return False
+        if index_offset + count * OFFSET.size != size - TRAILER.size:
+            return False
+
+        offset = devices_offset
+        for i in range(device_count):
+            if offset + 2 > index_offset:
+                return False
+            length = struct.unpack_from("<H", self.map, offset)[0]
+            if offset + 2 + length > index_offset:
+                return False
+            try:
+                self.devices.append(self.map[offset + 2:offset + 2 + length].decode("utf-8"))
+            except UnicodeDecodeError:
+                return False
+            offset += 2 + length
+
+        offsets = struct.unpack_from("<%dQ" % count, self.map, index_offset)
+        if offsets and offsets[-1] + RECORD.size > devices_offset:
+            return False
+        self.end = devices_offset
+        self.offsets = offsets
+        return True
+
+    def scan(self):
+        """Rebuild the index of a capture which was not closed."""
+        offsets = []
+        offset = HEADER.size
+        while offset + RECORD.size <= self.end:
+            size = RECORD.unpack_from(self.map, offset)[3]
+            if offset + RECORD.size + size > self.end:
+                # Truncated record
+                break
+            offsets.append(offset)
+            offset += RECORD.size + size
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        offset = self.offsets[i]
+        timestamp, device, direction, size = RECORD.unpack_from(self.map, offset)
+        data = self.map[offset + RECORD.size:offset + RECORD.size + size]
+        return CapturedFrame(timestamp, device, direction, data)
+
+    def timestamp(self, i):
+        return RECORD.unpack_from(self.map, self.offsets[i])[0]
+
+    def index_at(self, timestamp):
+        """Number of the first frame at or after timestamp (in seconds)."""
+        low, high = 0, len(self.offsets)
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def frames(self, start=0, direction=None, device=None):
+        for i in range(start, len(self.offsets)):
+            frame = self[i]
+            if direction is not None and frame.direction != direction:
+                continue
+            if device is not None and frame.device != device:
+                continue
+            yield frame
+
+    def replay(self, start_time=0.0, realtime=True, speed=1.0, direction=INPUT, device=None):
+        """Yield the frames from start_time on, at their original pace
+        (divided by speed) if realtime, else as fast as possible."""
+        origin = None
+        for frame in self.frames(self.index_at(start_time), direction, device):
+            if realtime:
+                now = monotonic()
+                if origin is None:
+                    origin = now - frame.timestamp / speed
+                delay = origin + frame.timestamp / speed - now
+                if delay > 0:
+                    time.sleep(delay)
+            yield frame
+
+    def close(self):
+        self.map.close()
+
+    # End of the class CaptureReader
+
+
+class ReplayTransport(Transport):
+    """Feed the input frames of a capture to a ZeemoteControl.
+
+    The keyword arguments are the ones of CaptureReader.replay().  What
+    the host sends is dropped.
+    """
+    def __init__(self, reader, **kwargs):
+        self.frames = reader.replay(**kwargs)
+        self.realtime = kwargs.get("realtime", True)
+        self.pending = b""
+        # A pipe with a byte never read is always readable, for select()
+        self.pipe = os.pipe()
+        os.write(self.pipe[1], b"\x00")
+
+    def recv(self, size):
+        chunks = [self.pending]
+        total = len(self.pending)
+        while total < size:
+            frame = next(self.frames, None)
+            if frame is None:
+                break
+            chunks.append(frame.data)
+            total += len(frame.data)
+            if self.realtime:
+                # Don't hold a frame back while waiting for the next ones
+                break
+        data = b"".join(chunks)
+        self.pending = data[size:]
+        return data[:size]
+
+    def send(self, data):
+        return len(data)
+
+    def fileno(self):
+        return self.pipe[0]
+
+    def close(self):
+        os.close(self.pipe[0])
+        os.close(self.pipe[1])
+
+    # End of the class ReplayTransport
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the frames of a capture file")
+    parser.add_argument("capture")
+    parser.add_argument("--start", type=float, default=0.0, help="first second to print")
+    args = parser.parse_args()
+
+    reader = CaptureReader(args.capture)
+    print("%d frames, devices: %s" % (len(reader), ", ".join(reader.devices)))
+    for frame in reader.frames(reader.index_at(args.start)):
+        print("%12.6f %d %s %s" % (frame.timestamp, frame.device,
+                                   "<-" if frame.direction == INPUT else "->",
+                                   " ".join("%02x" % byte for byte in bytearray(frame.data))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+
+# 
+# LICENSE
+# 
+# Copyright (c) 2010, University College Dublin, National University of
+# Ireland, Dublin
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# - Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# 
+# - Neither the name University College Dublin, National University of
+# Ireland, Dublin nor the names of its contributors may be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# Event dispatching: callbacks run when a button is pressed or released,
+# when the joystick enters or leaves a direction, or for given reports
+#
+
+from __future__ import print_function
+
+import zeemote_listener as zl
+
+# Joystick directions
+LEFT   = "left"
+RIGHT  = "right"
+UP     = "up"
+DOWN   = "down"
+CENTER = "center"
+
+# Full scale of the readings of the 2-axis joystick reports
+AXIS_SCALE = {
+    0x08: 127,
+    0x09: 32767,
+    0x0A: 2147483647,
+}
+
+
+def directions(x, y, threshold):
+    """Set of the directions pointed by a joystick position."""
+    pointed = set()
+    if x < -threshold:
+        pointed.add(LEFT)
+    elif x > threshold:
+        pointed.add(RIGHT)
+    if y < -threshold:
+        pointed.add(UP)
+    elif y > threshold:
+        pointed.add(DOWN)
+    if not pointed:
+        pointed.add(CENTER)
+    return frozenset(pointed)
+
+
+class EventDispatcher():
+    """Call handlers on the changes of the controller state.
+
+    The state (held keys, directions of each joystick) is compared with the
+    previous one on every report, so press/release and enter/leave handlers
+    only run on edges, not on every frame:
+
+        dispatcher = EventDispatcher()
+        dispatcher.on_press(0, start_playing)
+        dispatcher.on_direction(zeemote_events.LEFT, on_enter=previous_song)
+        dispatcher.run(zeemote)
+
+    threshold is the fraction of the full scale under which an axis is
+    considered centered.
+    """
+    def __init__(self, threshold=0.0):
+        self.threshold = threshold
+        self.report_handlers = {}
+        self.press_handlers = {}
+        self.release_handlers = {}
+        self.enter_handlers = {}
+        self.leave_handlers = {}
+
+        # Bitmask of the keys held
+        self.keys = 0
+        # joystick ID -> directions
+        self.directions = {}
+
+    def on_report(self, report_id, callback):
+        """callback(report) on every report of this ID."""
+        self.report_handlers.setdefault(report_id, []).append(callback)
+
+    def on_press(self, key, callback):
+        """callback(key) when key is pressed, any key if key is None."""
+        self.press_handlers.setdefault(key, []).append(callback)
+
+    def on_release(self, key, callback):
+        """callback(key) when key is released, any key if key is None."""
+        self.release_handlers.setdefault(key, []).append(callback)
+
+    def on_direction(self, direction, on_enter=None, on_leave=None):
+        """on_enter(direction) / on_leave(direction) when the joystick
+        starts / stops pointing to direction (CENTER included)."""
+        if on_enter is not None:
+            self.enter_handlers.setdefault(direction, []).append(on_enter)
+        if on_leave is not None:
+            self.leave_handlers.setdefault(direction, []).append(on_leave)
+
+    def fire(self, handlers, key, arg):
+        for callback in handlers.get(key, ()):
+            callback(arg)
+
+    def fire_any(self, handlers, key):
+        self.fire(handlers, key, key)
+        self.fire(handlers, None, key)
+
+    def dispatch(self, report):
+        report_id = report.report_id
+        self.fire(self.report_handlers, report_id, report)
+
+        if report_id == 0x07:
+            mask = report.mask
+            changed = mask ^ self.keys
+            if changed:
+                released = changed & self.keys
+                pressed = changed & mask
+                self.keys = mask
+                for key in zl.mask_keys(released):
+                    self.fire_any(self.release_handlers, key)
+                for key in zl.mask_keys(pressed):
+                    self.fire_any(self.press_handlers, key)
+
+        elif report_id in AXIS_SCALE:
+            threshold = self.threshold * AXIS_SCALE[report_id]
+            pointed = directions(report.x, report.y, threshold)
+            previous = self.directions.get(report.joystick_id, frozenset([CENTER]))
+            if pointed != previous:
+                self.directions[report.joystick_id] = pointed
+                for direction in previous - pointed:
+                    self.fire(self.leave_handlers, direction, direction)
+                for direction in pointed - previous:
+                    self.fire(self.enter_handlers, direction, direction)
+
+    def run(self, zeemote):
+        """Dispatch the reports of a ZeemoteControl while it is connected."""
+        while zeemote.connected:
+            for report in zeemote.listen_many():
+                self.dispatch(report)
+
+    # End of the class EventDispatcher
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+
+# 
+# LICENSE
+# 
+# Copyright (c) 2010, University College Dublin, National University of
+# Ireland, Dublin
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# - Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# 
+# - Neither the name University College Dublin, National University of
+# Ireland, Dublin nor the names of its contributors may be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# Several Zeemote controllers served by a single thread
+#
+
+from __future__ import print_function
+
+try:
+    import selectors
+except ImportError:
+    # Python 2
+    import selectors34 as selectors
+
+import zeemote_listener as zl
+from zeemote_cache import ServiceCache
+
+
+class ZeemoteHub():
+    """Connect to many Zeemote controllers and multiplex their sockets.
+
+    Every device gets its own ZeemoteControl, but they are all read from
+    one selectors loop.  Reports come out tagged with the address of the
+    device which sent them:
+
+        hub = ZeemoteHub()
+        hub.connect()
+        for address, report in hub:
+            ...
+    """
+    def __init__(self, addresses=None, tries_nb=3, cache=None):
+        # When None, connect to every Zeemote found
+        self.addresses = addresses
+        self.number_of_tries = tries_nb
+        # Endpoints found by SDP, shared by the devices; False to disable
+        self.cache = ServiceCache() if cache is None else cache
+        self.selector = selectors.DefaultSelector()
+        # address -> ZeemoteControl
+        self.devices = {}
+
+    def discover(self):
+        """Return the (address, port, name) of the Zeemote devices to use."""
+        service_matches = []
+        if self.addresses is None:
+            while self.number_of_tries > 0 and len(service_matches) == 0:
+                self.number_of_tries -= 1
+                service_matches = zl.find_service(uuid=zl.ZEEMOTE_UUID)
+        else:
+            for address in self.addresses:
+                cached = self.cache.get(address) if self.cache else []
+                if cached:
+                    host, port, name = cached[0]
+                    service_matches.append({"host": host, "port": port, "name": name})
+                    continue
+                tries = self.number_of_tries
+                matches = []
+                while tries > 0 and len(matches) == 0:
+                    tries -= 1
+                    matches = zl.find_service(uuid=zl.ZEEMOTE_UUID, address=address)
+                service_matches.extend(matches[:1])
+
+        endpoints = []
+        seen = set()
+        for match in service_matches:
+            if match["host"] not in seen:
+                seen.add(match["host"])
+                endpoints.append((match["host"], match["port"], match["name"]))
+        return endpoints
+
+    def connect(self, endpoints=None):
+        """Connect to every endpoint not connected yet, return their number."""
+        if endpoints is None:
+            if zl.debug:
+                print("Trying to find Zeemote devices...")
+            endpoints = self.discover()
+
+        for address, port, name in endpoints:
+            if address in self.devices:
+                continue
+            zeemote = zl.ZeemoteControl(cache=self.cache)
+            zeemote.connect(address, port, name)
+            if not zeemote.connected and self.cache and self.cache.get(address):
+                # Stale cache entry: look the device up again
+                self.cache.forget(address)
+                zeemote.connect(address)
+            if zeemote.connected:
+                self.add(zeemote)
+
+        return len(self.devices)
+
+    def add(self, zeemote):
+        """Start serving an already connected ZeemoteControl."""
+        self.devices[zeemote.address] = zeemote
+        self.selector.register(zeemote.sock, selectors.EVENT_READ, zeemote)
+
+    def remove(self, address):
+        zeemote = self.devices.pop(address)
+        self.selector.unregister(zeemote.sock)
+        zeemote.disconnect()
+
+    def disconnect(self):
+        for address in list(self.devices):
+            self.remove(address)
+
+    def listen_many(self, timeout=None):
+        """Return the (address, report) received from all devices.
+
+        Waits at most timeout seconds (forever if None) for one of the
+        sockets to be readable, then reads each ready socket once and
+        returns every complete report.  Devices whose link is lost are
+        removed from the hub.
+        """
+        reports = []
+        for key, mask in self.selector.select(timeout):
+            zeemote = key.data
+            for report in self.read(zeemote) or ():
+                reports.append((zeemote.address, report))
+
+        return reports
+
+    def read(self, zeemote):
+        """Read a device whose socket is ready, return its reports, or None
+        if its link is lost (it is then removed)."""
+        try:
+            zeemote.reader.fill()
+        except zl.BluetoothError:
+            if zl.debug:
+                print("Lost %s" % zeemote.address)
+            self.remove(zeemote.address)
+            return None
+
+        return list(zeemote.iter_reports())
+
+    def __iter__(self):
+        while self.devices:
+            for item in self.listen_many():
+                yield item
+
+    # End of the class ZeemoteHub
@@ -0,0 +1,249 @@
+#!/usr/bin/python
+
+# 
+# LICENSE
+# 
+# Copyright (c) 2010, University College Dublin, National University of
+# Ireland, Dublin
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# - Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# 
+# - Neither the name University College Dublin, National University of
+# Ireland, Dublin nor the names of its contributors may be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# Key handling on bitmasks: press and release edges, auto-repeat and
+# chords, timed by a timer wheel
+#
+
+from __future__ import print_function
+
+import math
+
+import zeemote_listener as zl
+
+
+class Timer():
+    __slots__ = ('due', 'callback', 'args', 'active')
+
+    def __init__(self, due, callback, args):
+        self.due = due
+        self.callback = callback
+        self.args = args
+        self.active = True
+
+    # End of the class Timer
+
+
+class TimerWheel():
+    """Hashed timer wheel: slots of tick seconds, a timer goes in the slot
+    of its due tick (modulo the number of slots), so scheduling and
+    cancelling cost O(1) and advancing one tick only looks at one slot.
+    """
+    def __init__(self, tick=0.01, slots=256, now=None):
+        self.tick = tick
+        self.slots = [[] for i in range(slots)]
+        # Ticks elapsed, since the origin of zl.timer()
+        self.current = int((zl.timer() if now is None else now) / tick)
+        self.active = 0
+
+    def schedule(self, delay, callback, *args):
+        """Call callback(*args) delay seconds from now (rounded up to the
+        next tick), return a Timer to cancel it."""
+        due = self.current + max(1, int(math.ceil(delay / self.tick)))
+        timer = Timer(due, callback, args)
+        self.slots[due % len(self.slots)].append(timer)
+        self.active += 1
+        return timer
+
+    def cancel(self, timer):
+        # Removed from its slot when the wheel gets there
+        if timer.active:
+            timer.active = False
+            self.active -= 1
+
+    def advance(self, now=None):
+        """Fire the timers due by now."""
+        target = int((zl.timer() if now is None else now) / self.tick)
+        slots = self.slots
+        n = len(slots)
+        idle = target - self.current > n
+        if idle:
+            # Idle for more than a turn: look at every slot once
+            steps = range(self.current + 1, self.current + n + 1)
+            self.current = target
+        else:
+            steps = range(self.current + 1, target + 1)
+        for tick in steps:
+            if not idle:
+                # Timers scheduled by the callbacks start from their tick
+                self.current = tick
+            index = tick % n
+            slot = slots[index]
+            if not slot:
+                continue
+            # Callbacks may schedule timers in this very slot
+            slots[index] = []
+            for timer in slot:
+                if not timer.active:
+                    continue
+                if timer.due <= target:
+                    timer.active = False
+                    self.active -= 1
+                    timer.callback(*timer.args)
+                else:
+                    slots[index].append(timer)
+
+    def timeout(self, now=None):
+        """Seconds until the next timer is due, None if there is none."""
+        if not self.active:
+            return None
+        due = min(timer.due for slot in self.slots for timer in slot if timer.active)
+        now = zl.timer() if now is None else now
+        return max(0.0, due * self.tick - now)
+
+    # End of the class TimerWheel
+
+
+class KeyEngine():
+    """Key events from the key reports (0x07).
+
+    The keys held are kept as a bitmask: the keys pressed and released by
+    a report are found with a XOR against the previous mask, so a report
+    which changes nothing costs next to nothing.  A key held for
+    repeat_delay seconds repeats every repeat_interval seconds.  A chord
+    fires when all its keys are pressed within chord_window seconds of
+    each other (the presses of its keys are reported too).
+
+    The timers run from advance(); between reports, wait at most
+    timeout() seconds:
+
+        engine = KeyEngine()
+        engine.on_repeat(0x02, scroll)
+        engine.on_chord([0x00, 0x01], menu)
+        while True:
+            report = reader.listen(engine.timeout())
+            engine.advance()
+            if report is not None:
+                engine.feed(report)
+    """
+    def __init__(self, repeat_delay=0.5, repeat_interval=0.1, chord_window=0.05, wheel=None):
+        self.repeat_delay = repeat_delay
+        self.repeat_interval = repeat_interval
+        self.chord_window = chord_window
+        self.wheel = wheel or TimerWheel()
+
+        self.mask = 0
+        # key -> time of its press, key -> repeat Timer
+        self.pressed_at = {}
+        self.timers = {}
+        # chord mask -> callbacks, chords currently held
+        self.chords = {}
+        self.active_chords = set()
+
+        self.press_handlers = {}
+        self.release_handlers = {}
+        self.repeat_handlers = {}
+
+    def on_press(self, key, callback):
+        """callback(key) when key is pressed, any key if key is None."""
+        self.press_handlers.setdefault(key, []).append(callback)
+
+    def on_release(self, key, callback):
+        """callback(key) when key is released, any key if key is None."""
+        self.release_handlers.setdefault(key, []).append(callback)
+
+    def on_repeat(self, key, callback):
+        """callback(key) on each repetition of a held key."""
+        self.repeat_handlers.setdefault(key, []).append(callback)
+
+    def on_chord(self, keys, callback):
+        """callback(keys) when keys are pressed together."""
+        self.chords.setdefault(zl.key_mask(keys), []).append(callback)
+
+    def fire(self, handlers, key):
+        for callback in handlers.get(key, ()):
+            callback(key)
+        for callback in handlers.get(None, ()):
+            callback(key)
+
+    def timeout(self, now=None):
+        return self.wheel.timeout(now)
+
+    def advance(self, now=None):
+        self.wheel.advance(now)
+
+    def feed(self, report, now=None):
+        if report.report_id != 0x07:
+            return
+        mask = report.mask
+        changed = mask ^ self.mask
+        if not changed:
+            return
+        now = zl.timer() if now is None else now
+        self.advance(now)
+        released = changed & self.mask
+        pressed = changed & mask
+        self.mask = mask
+
+        for key in zl.mask_keys(released):
+            self.pressed_at.pop(key, None)
+            timer = self.timers.pop(key, None)
+            if timer is not None:
+                self.wheel.cancel(timer)
+            self.fire(self.release_handlers, key)
+        if released:
+            self.active_chords = set(chord for chord in self.active_chords if chord & mask == chord)
+
+        for key in zl.mask_keys(pressed):
+            self.pressed_at[key] = now
+            if self.repeat_handlers:
+                self.timers[key] = self.wheel.schedule(self.repeat_delay, self.repeat, key)
+            self.fire(self.press_handlers, key)
+        if pressed and self.chords:
+            self.check_chords(pressed)
+
+    def check_chords(self, pressed):
+        mask = self.mask
+        for chord, callbacks in self.chords.items():
+            if chord & pressed and chord & mask == chord and chord not in self.active_chords:
+                times = [self.pressed_at[key] for key in zl.mask_keys(chord)]
+                if max(times) - min(times) <= self.chord_window:
+                    self.active_chords.add(chord)
+                    keys = tuple(zl.mask_keys(chord))
+                    for callback in callbacks:
+                        callback(keys)
+
+    def repeat(self, key):
+        self.timers[key] = self.wheel.schedule(self.repeat_interval, self.repeat, key)
+        for callback in self.repeat_handlers.get(key, ()):
+            callback(key)
+        for callback in self.repeat_handlers.get(None, ()):
+            callback(key)
+
+    # End of the class KeyEngine
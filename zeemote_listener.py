@@ -36,10 +36,42 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # 
 
-from bluetooth import *
+from __future__ import print_function
+
+from binascii import hexlify
+from bisect import bisect_left
+from collections import deque, namedtuple, OrderedDict
+from itertools import islice
+import json
+import logging
+import os
+import select
+import struct
 import sys
+import threading
+import time
+
+from zeemote_cache import DeviceInfoCache, ServiceCache
+from zeemote_capture import shared_trace, INPUT as CAPTURE_INPUT, OUTPUT as CAPTURE_OUTPUT
+from zeemote_transport import *
 
 debug = True
+# Debug captures of the process (%d: process ID), shared by its controls:
+# PREFIX-0.zcap, then PREFIX-1.zcap once every control closed the first one
+CAPTURE_PREFIX = "/tmp/zeemote_talking-%d"
+
+# Per frame logging: reports at DEBUG level, hex dumps of the frames at TRACE
+log = logging.getLogger("zeemote")
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+
+timer = getattr(time, "perf_counter", time.time)
+
+# Service class of the Zeemote Controller Protocol
+ZEEMOTE_UUID = "8E1F0CF7-508F-4875-B62C-FBB67FD34812"
+
+# Header byte of the input reports (HID DATA | Input)
+HEADER_DATA_INPUT = 0xA1
 
 #
 # Special Exception
@@ -54,664 +86,1248 @@ class LengthPacketException(Exception):
 
     # End of the class LengthPacketException
 
+class HandshakeTimeout(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return "No handshake for the output report %s" % hexlify(self.msg[1:3]).decode("ascii")
+
+    # End of the class HandshakeTimeout
+
+class HandshakeError(Exception):
+    def __init__(self, msg, code):
+        self.msg = msg
+        self.code = code
+    def __str__(self):
+        return "Output report %s rejected with the handshake %s" % (
+            hexlify(self.msg[1:3]).decode("ascii"), hexlify(self.code).decode("ascii"))
+
+    # End of the class HandshakeError
+
 
 #
-# Zeemote listening class
+# Reports
+#
+# Every report is an immutable namedtuple whose first field is the report
+# ID.  Numbers are decoded to ints, axis readings are signed.  unpack()
+# builds a report from the values of its struct layout, pack() gives them
+# back.
 #
-class ZeemoteControl():
-    # Handshakes types
-    HANDSHAKE_SUCCESSFUL              = "\x00"
-    HANDSHAKE_NOT_READY               = "\x01"
-    HANDSHAKE_ERR_INVALID_REPORT_ID   = "\x02"
-    HANDSHAKE_ERR_UNSUPPORTED_REQUEST = "\x03"
-    HANDSHAKE_ERR_INVALID_PARAMETER   = "\x04"
-    HANDSHAKE_ERR_UNKNOWN             = "\x0E"
-    HANDSHAKE_ERR_FATAL               = "\x0F"
-
-    def __init__(self, tries_nb=3):
-        self.number_of_tries = tries_nb
 
-        self.connected = False
-        self.debug_file = None
-        if debug:
-            try:
-                self.debug_file = open("/tmp/zeemote_talking", "w")
-            except IOError, (e):
-                print "No debug file for this session: ", e
-
-    def connect(self):
-        address = None
-        port    = None
-        name    = None
-        uuid = "8E1F0CF7-508F-4875-B62C-FBB67FD34812"
-        service_matches = ""
-        self.sock = BluetoothSocket( RFCOMM )
-        try:
-            if debug:
-                print "Trying to find a Zeemote device..."
-            while(self.number_of_tries > 0 and len(service_matches) == 0):
-                self.number_of_tries -= 1
-                service_matches = find_service( uuid = uuid )
-
-            if len(service_matches) == 0:
-                print "Couldn't find any Zeemote device"
-                raise Exception("No zeemote device found")
-
-            first_match = service_matches[0]
-            port    = first_match["port"]
-            address = first_match["host"]
-            name    = first_match["name"]
-
-            if debug:
-                print "One Zeemote device found: %s (%s)" % (name, address)
-
-            self.sock.connect((address, port))
-        except KeyboardInterrupt, BluetoothError:
-            print "Unable to connect to the Zeemote controller"
-        else:
-            # if connection succeeded
-            print "Connected to %s (%s, %d)" % (name, address, port)
-            self.connected = True
-    
-    def disconnect(self):
-        if self.connected:
-            self.sock.close()
-            self.connected = False
-            if self.debug_file:
-                try:
-                    self.debug_file.close()
-                except:
-                    pass
-            print "Disconnected from the Zeemote controller"
+# Value of the unused key code slots of a KeyReport
+KEY_NONE = 0xFE
+
+def key_mask(keys):
+    """Bitmask of the key codes in keys: bit n is set when key n is held."""
+    mask = 0
+    for key in keys:
+        if key != KEY_NONE:
+            mask |= 1 << key
+    return mask
+
+def mask_keys(mask):
+    """Key codes of a bitmask, lowest first."""
+    keys = []
+    while mask:
+        low = mask & -mask
+        keys.append(low.bit_length() - 1)
+        mask ^= low
+    return keys
 
-    def listen(self):
-        try:
-            length = self.sock.recv(1)
-            input_id = self.sock.recv(1)
-        except KeyboardInterrupt:
-            self.disconnect()
+def unpack_fields(cls, report_id, values):
+    return cls(report_id, *values)
+
+def unpack_joystick(cls, report_id, values):
+    # The first byte holds the Raw bit and the Joystick ID
+    byte = values[0]
+    return cls(report_id, byte >> 7, byte & 0x7F, *values[1:])
+
+def pack_fields(self):
+    return self[1:]
+
+def pack_joystick(self):
+    return ((self.raw << 7) | self.joystick_id,) + self[3:]
+
+class Report(namedtuple('Report', 'report_id')):
+    __slots__ = ()
+    unpack = classmethod(unpack_fields)
+    pack = pack_fields
+
+class UnknownReport(namedtuple('UnknownReport', 'report_id payload')):
+    __slots__ = ()
+
+class FirmwareReport(namedtuple('FirmwareReport', 'report_id major minor revision platform_id model_id model_name')):
+    __slots__ = ()
+
+    @classmethod
+    def unpack(cls, report_id, values):
+        major, minor, revision, platform_id, model_id, name_length, name = values
+        return cls(report_id, major, minor, revision, platform_id, model_id, name[:name_length])
+
+    def pack(self):
+        return self[1:6] + (len(self.model_name), self.model_name)
+
+class ButtonDescriptionReport(namedtuple('ButtonDescriptionReport', 'report_id button_id game_action description')):
+    __slots__ = ()
+
+    @classmethod
+    def unpack(cls, report_id, values):
+        button_id, game_action, description_length, description = values
+        return cls(report_id, button_id, game_action, description[:description_length])
+
+    def pack(self):
+        return (self.button_id, self.game_action, len(self.description), self.description)
+
+class ValueReport(namedtuple('ValueReport', 'report_id type value')):
+    __slots__ = ()
+    unpack = classmethod(unpack_fields)
+    pack = pack_fields
+
+class KeyReport(namedtuple('KeyReport', 'report_id keys')):
+    __slots__ = ()
+
+    @classmethod
+    def unpack(cls, report_id, values):
+        return cls(report_id, values)
+
+    def pack(self):
+        return self.keys
+
+    @property
+    def pressed(self):
+        return tuple(key for key in self.keys if key != KEY_NONE)
+
+    @property
+    def mask(self):
+        return key_mask(self.keys)
+
+class JoystickReport(namedtuple('JoystickReport', 'report_id raw joystick_id x y')):
+    __slots__ = ()
+    unpack = classmethod(unpack_joystick)
+    pack = pack_joystick
+
+class Joystick3Report(namedtuple('Joystick3Report', 'report_id raw joystick_id x y z')):
+    __slots__ = ()
+    unpack = classmethod(unpack_joystick)
+    pack = pack_joystick
+
+class AxisReport(namedtuple('AxisReport', 'report_id raw joystick_id z')):
+    __slots__ = ()
+    unpack = classmethod(unpack_joystick)
+    pack = pack_joystick
+
+class BatteryReport(namedtuple('BatteryReport', 'report_id voltage')):
+    __slots__ = ()
+    unpack = classmethod(unpack_fields)
+    pack = pack_fields
+
+class ProtocolVersionReport(namedtuple('ProtocolVersionReport', 'report_id major minor revision')):
+    __slots__ = ()
+    unpack = classmethod(unpack_fields)
+    pack = pack_fields
+
+class TestReport(namedtuple('TestReport', 'report_id data')):
+    __slots__ = ()
+    unpack = classmethod(unpack_fields)
+    pack = pack_fields
+
+
+#
+# Input reports layouts
+#
+class ReportLayout():
+    """How to decode the payload (what follows the report ID) of a report.
+
+    length is the expected value of the length byte and fmt the big-endian
+    struct format of the payload, whose values are given to cls.unpack().
+    """
+    def __init__(self, length, cls, fmt):
+        self.length = length
+        self.cls = cls
+        self.struct = struct.Struct(">" + fmt)
+        self.unpack = cls.unpack
+
+    # End of the class ReportLayout
+
+
+REPORT_LAYOUTS = {
+    0x03: ReportLayout(45, FirmwareReport, "HHHHHB32s"),
+    0x04: ReportLayout(37, ButtonDescriptionReport, "BBB32s"),
+    0x05: ReportLayout(7, ValueReport, "BI"),
+    # report #0x06 is an output report
+    0x07: ReportLayout(8, KeyReport, "BBBBBB"),
+    # 2-axis joystick, 8, 16 and 32 bits readings
+    0x08: ReportLayout(5, JoystickReport, "Bbb"),
+    0x09: ReportLayout(7, JoystickReport, "Bhh"),
+    0x0A: ReportLayout(11, JoystickReport, "Bii"),
+    # The layouts below are deduced from the report lengths, which follow
+    # the same 8/16/32 bits pattern as 0x08-0x0A: 3 axes, 1 axis, then
+    # again 2 axes and 1 axis
+    0x0B: ReportLayout(6, Joystick3Report, "Bbbb"),
+    0x0C: ReportLayout(9, Joystick3Report, "Bhhh"),
+    0x0D: ReportLayout(15, Joystick3Report, "Biii"),
+    0x0E: ReportLayout(4, AxisReport, "Bb"),
+    0x0F: ReportLayout(5, AxisReport, "Bh"),
+    0x10: ReportLayout(7, AxisReport, "Bi"),
+    0x11: ReportLayout(4, BatteryReport, "H"),
+    0x12: ReportLayout(5, JoystickReport, "Bbb"),
+    0x13: ReportLayout(7, JoystickReport, "Bhh"),
+    0x14: ReportLayout(11, JoystickReport, "Bii"),
+    0x15: ReportLayout(4, AxisReport, "Bb"),
+    0x16: ReportLayout(5, AxisReport, "Bh"),
+    0x17: ReportLayout(7, AxisReport, "Bi"),
+    # report #0x18 and 0x19 are outputs reports
+    0x1A: ReportLayout(2, Report, ""),
+    0x1B: ReportLayout(8, ProtocolVersionReport, "HHH"),
+    # Below are two reports for test purpose only
+    0xFD: ReportLayout(7, TestReport, "5s"),
+    # report #FE is an output report
+    0xFF: ReportLayout(6, TestReport, "4s"),
+}
+
+
+def encode_report(report):
+    """Build the frame of a report, the reverse of decode_report()."""
+    layout = REPORT_LAYOUTS.get(report.report_id)
+    if layout is None:
+        payload = report.payload
+        length = len(payload) + 2
+    else:
+        payload = layout.struct.pack(*report.pack())
+        length = layout.length
+    return struct.pack("BBB", length, HEADER_DATA_INPUT, report.report_id) + payload
+
+
+# Expected length byte of the frames of each input report ID, 0 if unknown
+FRAME_LENGTHS = bytearray(256)
+for report_id, layout in REPORT_LAYOUTS.items():
+    FRAME_LENGTHS[report_id] = layout.length
+
+
+def is_handshake(frame):
+    """Tell whether a frame is a handshake answering an output report."""
+    # Input reports come with the DATA header 0xA1, handshakes with
+    # 0x00-0x0F, the low nibble being the result code
+    return len(frame) > 1 and ord(frame[1:2]) & 0xF0 == 0
+
+
+def decode_report(frame):
+    """Decode a whole frame (length byte included) into a report."""
+    report_id = ord(frame[2:3]) if len(frame) > 2 else None
+
+    layout = REPORT_LAYOUTS.get(report_id)
+    if layout is None:
+        return UnknownReport(report_id, frame[3:])
+
+    if ord(frame[0:1]) != layout.length:
+        raise LengthPacketException(report_id, frame[0:1], layout.length)
+
+    return layout.unpack(report_id, layout.struct.unpack_from(frame, 3))
+
+
+#
+# Incremental frame parser
+#
+class ZcpParser():
+    """Turn an arbitrarily chunked ZCP byte stream into frames and reports.
+
+    The parser does no I/O: bytes are pushed in with feed(), or written by
+    the caller in the free space returned by writable() followed by a call
+    to written().  Partial frames are kept until the rest of them arrives.
+    Each frame starts with a length byte giving the number of bytes which
+    follow it.
+
+    Handshakes are not returned as frames: they complete, in order, the
+    waiters given to expect() for the output reports sent.  A waiter is a
+    future with done(), set_result() and set_exception(); those already
+    done (timed out or cancelled) are skipped.
+
+    With resync (for a stream coming from the device), a frame whose
+    header doesn't make sense, or whose length doesn't match the one of
+    its report ID, is dropped: the parser moves forward byte by byte until
+    a plausible frame starts.  errors counts these losses of sync and
+    skipped the bytes dropped; the owner of the parser may reset them.
+    """
+    def __init__(self, size=4096, resync=True):
+        # A frame is at most 256 bytes long
+        if size < 256:
+            raise ValueError("The parser buffer must hold at least 256 bytes")
+        self.buf = bytearray(size)
+        self.start = 0
+        self.end = 0
+        self.frames = 0
+        self.resync = resync
+        self.synced = True
+        self.errors = 0
+        self.skipped = 0
+        self.waiting = deque()
+        self.unexpected_handshakes = 0
+
+    def writable(self):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start > 0 and len(self.buf) - self.end < 256:
+            # Move the partial frame back to the beginning of the buffer
+            remaining = self.end - self.start
+            self.buf[:remaining] = self.buf[self.start:self.end]
+            self.start = 0
+            self.end = remaining
+        return memoryview(self.buf)[self.end:]
+
+    def written(self, n):
+        self.end += n
+
+    def feed(self, data):
+        """Append data to the stream and return the reports it completes."""
+        reports = []
+        data = memoryview(data)
+        while data:
+            space = len(self.writable())
+            n = min(space, len(data))
+            self.buf[self.end:self.end + n] = data[:n]
+            self.end += n
+            data = data[n:]
+            reports.extend(self.reports())
+        return reports
+
+    def next_frame(self):
+        """Return the next complete frame (length byte included) or None."""
+        buf = self.buf
+        available = self.end - self.start
+        while available > 0:
+            start = self.start
+            size = buf[start] + 1
+            if self.resync and not (
+                    # Fast path: an input report, in sync, of the right length
+                    self.synced and available > 2 and buf[start + 1] == HEADER_DATA_INPUT
+                    and FRAME_LENGTHS[buf[start + 2]] in (size - 1, 0) and size > 2):
+                plausible = self.plausible(start, available)
+                if plausible and not self.synced and available > size:
+                    # While resyncing, the next frame has to make sense too
+                    plausible = self.plausible(start + size, available - size) is not False
+                if plausible is None:
+                    break
+                if not plausible:
+                    if self.synced:
+                        self.synced = False
+                        self.errors += 1
+                    self.start += 1
+                    self.skipped += 1
+                    available -= 1
+                    continue
+                self.synced = True
+            if available < size:
+                break
+            frame = bytes(buf[start:start + size])
+            self.start += size
+            self.frames += 1
+            if not is_handshake(frame):
+                return frame
+            self.handshake(frame[1:2])
+            available -= size
+        return None
+
+    def plausible(self, start, available):
+        """Tell whether a frame can start at start, with available bytes
+        from there, or None when more bytes are needed to know."""
+        buf = self.buf
+        if available < 2:
             return None
-        except BluetoothError:
-            if self.number_of_tries > 0:
-                self.number_of_tries -= 1
-                self.disconnect()
-                if debug:
-                    print "Reconnecting..."
-                self.connect()
-                return None
-            else:
-                return None
+        length = buf[start]
+        header = buf[start + 1]
+        if header & 0xF0 == 0:
+            # Handshake
+            return length == 1
+        if header != HEADER_DATA_INPUT:
+            return False
+        if available < 3:
+            return None
+        layout = REPORT_LAYOUTS.get(buf[start + 2])
+        if layout is None:
+            # Unknown report ID: only its length byte can be trusted
+            return length >= 2
+        return length == layout.length
+
+    def expect(self, waiter):
+        """Queue a waiter for the handshake of the next output report."""
+        self.waiting.append(waiter)
+
+    def handshake(self, code):
+        waiting = self.waiting
+        while waiting and waiting[0].done():
+            waiting.popleft()
+        if waiting:
+            waiting.popleft().set_result(code)
+        else:
+            self.unexpected_handshakes += 1
+
+    def fail(self, exception):
+        """Fail every waiter, when the connection is closed."""
+        while self.waiting:
+            waiter = self.waiting.popleft()
+            if not waiter.done():
+                waiter.set_exception(exception)
+
+    def reports(self):
+        """Decode every complete frame currently buffered."""
+        frame = self.next_frame()
+        while frame is not None:
+            yield decode_report(frame)
+            frame = self.next_frame()
+
+    # End of the class ZcpParser
+
+
+#
+# Buffered frame reader
+#
+class FrameReader():
+    """Cut ZCP frames out of a socket with as few recv() calls as possible.
+
+    Whatever the socket has available is read straight into the buffer of
+    a ZcpParser and complete frames are sliced out of it, so a burst of
+    reports costs a single syscall.
+    """
+    def __init__(self, sock, size=4096):
+        self.sock = sock
+        self.parser = ZcpParser(size)
+        self.recv_into = getattr(sock, "recv_into", None)
+
+        # Totals for the whole session
+        self.syscalls = 0
+        self.bytes_read = 0
+        self.frames = 0
+        # Cost of the last frame returned by read_frame()
+        self.frame_syscalls = 0
+        self.frame_bytes = 0
+        self.pending_syscalls = 0
+
+    def fill(self):
+        space = self.parser.writable()
+        if self.recv_into:
+            n = self.recv_into(space)
+        else:
+            # Some Bluetooth sockets have no recv_into()
+            data = self.sock.recv(len(space))
+            n = len(data)
+            space[:n] = data
+
+        self.syscalls += 1
+        self.pending_syscalls += 1
+        if n == 0:
+            raise BluetoothError("Connection closed by the Zeemote controller")
+        self.bytes_read += n
+        self.parser.written(n)
+
+    def wait(self, timeout=None):
+        """Wait until the socket is readable, return False on timeout."""
+        return len(select.select([self.sock], [], [], timeout)[0]) > 0
+
+    def next_frame(self):
+        """Return the next frame already buffered, or None."""
+        frame = self.parser.next_frame()
+        if frame is not None:
+            self.frames += 1
+            self.frame_bytes = len(frame)
+            self.frame_syscalls = self.pending_syscalls
+            self.pending_syscalls = 0
+        return frame
+
+    def read_frame(self):
+        frame = self.next_frame()
+        while frame is None:
+            self.fill()
+            frame = self.next_frame()
+        return frame
+
+    # End of the class FrameReader
+
+
+#
+# Runtime statistics
+#
+class ReportStats():
+    __slots__ = ('count', 'bytes', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    # End of the class ReportStats
+
+
+# Upper bounds, in microseconds, of the decode latency histogram buckets;
+# the last bucket counts everything slower
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+class ZeemoteStats():
+    """Counters kept by a ZeemoteControl while it runs.
+
+    Per report ID: number of reports, bytes and a fixed buckets histogram
+    of the decode time.  Link health: length errors (frames dropped to
+    resync, and the bytes skipped), unknown reports,
+    lost links and reconnections, syscalls and the largest backlog of
+    received bytes not decoded yet, which grows with slow consumers.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.reports = {}
+        self.length_errors = 0
+        self.skipped_bytes = 0
+        self.unknown_reports = 0
+        self.link_errors = 0
+        self.reconnects = 0
+        self.syscalls = 0
+        self.max_backlog = 0
+
+    def record(self, report_id, size, elapsed):
+        stats = self.reports.get(report_id)
+        if stats is None:
+            stats = self.reports[report_id] = ReportStats()
+        stats.count += 1
+        stats.bytes += size
+        stats.histogram[bisect_left(LATENCY_BUCKETS, elapsed * 1e6)] += 1
+
+    def snapshot(self):
+        """Return a copy of the counters, as plain dicts and lists."""
+        reports = {}
+        for report_id, stats in self.reports.items():
+            reports["0x%02X" % report_id] = {
+                "count": stats.count,
+                "bytes": stats.bytes,
+                "latency_histogram": list(stats.histogram),
+            }
+        return {
+            "uptime": time.time() - self.started,
+            "reports": reports,
+            "latency_buckets_us": list(LATENCY_BUCKETS),
+            "length_errors": self.length_errors,
+            "skipped_bytes": self.skipped_bytes,
+            "unknown_reports": self.unknown_reports,
+            "link_errors": self.link_errors,
+            "reconnects": self.reconnects,
+            "syscalls": self.syscalls,
+            "max_backlog": self.max_backlog,
+        }
+
+    def export(self, path):
+        """Write a JSON snapshot to path, atomically."""
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+        os.rename(tmp, path)
+
+    # End of the class ZeemoteStats
 
-        if self.debug_file:
-            self.debug_file.write(length)
-            self.debug_file.write(input_id)
-            self.debug_file.flush()
 
+#
+# Output reports
+#
+# Each function returns the message to send to the device, or None when a
+# parameter is invalid.
+#
+def idle_message(time):
+    if not isinstance(time, bytes) or len(time) != 1:
         if debug:
-            print "Message length: %d" % ord(length)
-
-
-        #
-        # Here are the functions that are taking care of different IDs
-        #
-        def process_report_03(): # Input report #0x03
-            if debug:
-                print "process_report_03"
-            if length != "\x2d":
-                raise LengthPacketException(3, length, 45)
-
-            data['Firmware Major Version'] = self.sock.recv(2)
-            data['Firmware Minor Version'] = self.sock.recv(2)
-            data['Firmware Revision'] = self.sock.recv(2)
-            data['Platform ID'] = self.sock.recv(2)
-            data['Model ID'] = self.sock.recv(2)
-            data['Model Name Length'] = self.sock.recv(1)
-            data['Model Name'] = self.sock.recv(32)
-
-            if self.debug_file:
-                self.debug_file.write(data['Firmware Major Version'])
-                self.debug_file.write(data['Firmware Minor Version'])
-                self.debug_file.write(data['Firmware Revision'])
-                self.debug_file.write(data['Platform ID'])
-                self.debug_file.write(data['Model ID'])
-                self.debug_file.write(data['Model Name Length'])
-                self.debug_file.write(data['Model Name'])
-                self.debug_file.flush()
-
-        def process_report_04(): # Input report #0x04
-            if debug:
-                print "process_report_04"
-    
-            if length != "\x25":
-                raise LengthPacketException(4, length, 37)
-
-            data['Button ID'] = self.sock.recv(1)
-            data['Recommended Game Action'] = self.sock.recv(1)
-            data['Button Description Length'] = self.sock.recv(1)
-            data['Button Description'] = self.sock.recv(32)
-    
-            if self.debug_file:
-                self.debug_file.write(data['Button ID'])
-                self.debug_file.write(data['Recommended Game Action'])
-                self.debug_file.write(data['Button Description Length'])
-                self.debug_file.write(data['Button Description'])
-                self.debug_file.flush()
-    
-        def process_report_05(): # Input report #0x05
-            if debug:
-                print "process_report_05"
-    
-            if length != "\x07":
-                raise LengthPacketException(5, length, 7)
-
-            data['Type'] = self.sock.recv(1)
-            data['Value'] = self.sock.recv(4)
-    
-            if self.debug_file:
-                self.debug_file.write(data['Type'])
-                self.debug_file.write(data['Value'])
-                self.debug_file.flush()
-    
-        # report #0x06 is an output report
-
-        def process_report_07(): # Input report #0x07
-            if debug:
-                print "process_report_07"
-
-            if length != "\x08":
-                raise LengthPacketException(7, length, 8)
-
-            data['Key Code 1'] = self.sock.recv(1)
-            data['Key Code 2'] = self.sock.recv(1)
-            data['Key Code 3'] = self.sock.recv(1)
-            data['Key Code 4'] = self.sock.recv(1)
-            data['Key Code 5'] = self.sock.recv(1)
-            data['Key Code 6'] = self.sock.recv(1)
-    
-            if self.debug_file:
-                self.debug_file.write(data['Key Code 1'])
-                self.debug_file.write(data['Key Code 2'])
-                self.debug_file.write(data['Key Code 3'])
-                self.debug_file.write(data['Key Code 4'])
-                self.debug_file.write(data['Key Code 5'])
-                self.debug_file.write(data['Key Code 6'])
-                self.debug_file.flush()
-
-        def process_report_08(): # Input report #0x08
-            if debug:
-                print "process_report_08"
-    
-            if length != "\x05":
-                raise LengthPacketException(8, length, 5)
-
-            byte = self.sock.recv(1)
-            # We keep only the extrem left bit (is only 0 or 1)
-            data['Raw'] = (ord(byte) & 0x80) >> 7
-            # We keep all the others bits (is an entire byte)
-            data['Joystick ID'] = ord(byte) & 0x7F
-            data['X-Axis Reading'] = self.sock.recv(1)
-            data['Y-Axis Reading'] = self.sock.recv(1)
-    
-            if self.debug_file:
-                self.debug_file.write(byte)
-                self.debug_file.write(data['X-Axis Reading'])
-                self.debug_file.write(data['Y-Axis Reading'])
-                self.debug_file.flush()
-
-        def process_report_09(): # Input report #0x09
-            if debug:
-                print "process_report_09"
-    
-            if length != "\x07":
-                raise LengthPacketException(9, length, 7)
-
-            byte = self.sock.recv(1)
-            # We keep only the left bit (is only 0 or 1)
-            data['Raw'] = (ord(byte) & 0x80) >> 7
-            # We keep all the others bits (is an entire byte)
-            data['Joystick ID'] = ord(byte) & 0x7F
-            data['X-Axis Reading'] = self.sock.recv(2)
-            data['Y-Axis Reading'] = self.sock.recv(2)
-    
-            if self.debug_file:
-                self.debug_file.write(byte)
-                self.debug_file.write(data['X-Axis Reading'])
-                self.debug_file.write(data['Y-Axis Reading'])
-                self.debug_file.flush()
-
-        def process_report_0A(): # Input report #0x0A
-            if debug:
-                print "process_report_0A"
-    
-            if length != "\x0b":
-                raise LengthPacketException(int("0x0a", 16), length, 11)
-
-            byte = self.sock.recv(1)
-            # We keep only the left bit (is only 0 or 1)
-            data['Raw'] = (ord(byte) & 0x80) >> 7
-            # We keep all the others bits (is an entire byte)
-            data['Joystick ID'] = ord(byte) & 0x7F
-            data['X-Axis Reading'] = self.sock.recv(4)
-            data['Y-Axis Reading'] = self.sock.recv(4)
-    
-            if self.debug_file:
-                self.debug_file.write(byte)
-                self.debug_file.write(data['X-Axis Reading'])
-                self.debug_file.write(data['Y-Axis Reading'])
-                self.debug_file.flush()
-
-        def process_report_0B(): # Input report #0x0B
-            if debug:
-                print "process_report_0B"
-    
-            if length != "\x06":
-                raise LengthPacketException(int("0x0b", 16), length, 6)
-    
-            if debug:
-                print "passing..."
-            self.sock.recv(ord(length) - 2)
-
-        def process_report_0C(): # Input report #0x0C
-            if debug:
-                print "process_report_0C"
-    
-            if length != "\x09":
-                raise LengthPacketException(int("0x0c", 16), length, 9)
-    
-            if debug:
-                print "passing..."
-            self.sock.recv(ord(length) - 2)
-
-        def process_report_0D(): # Input report #0x0D
-            if debug:
-                print "process_report_0D"
-    
-            if length != "\x0f":
-                raise LengthPacketException(int("0x0d", 16), length, 15)
-    
-            if debug:
-                print "passing..."
-            self.sock.recv(ord(length) - 2)
-
-        def process_report_0E(): # Input report #0x0E
-            if debug:
-                print "process_report_0E"
-    
-            if length != "\x04":
-                raise LengthPacketException(int("0x0e", 16), length, 4)
-    
-            if debug:
-                print "passing..."
-            self.sock.recv(ord(length) - 2)
-
-        def process_report_0F(): # Input report #0x0F
-            if debug:
-                print "process_report_0F"
-    
-            if length != "\x05":
-                raise LengthPacketException(int("0x0f", 16), length, 5)
-    
-            if debug:
-                print "passing..."
-            self.sock.recv(ord(length) - 2)
-
-        def process_report_10(): # Input report #0x10
-            if debug:
-                print "process_report_10"
-    
-            if length != "\x07":
-                raise LengthPacketException(int("0x10", 16), length, 7)
-    
-            if debug:
-                print "passing..."
-            self.sock.recv(ord(length) - 2)
-
-        def process_report_11(): # Input report #0x11
-            if debug:
-                print "process_report_11"
-
-            if length != "\x04":
-                raise LengthPacketException(int("0x11", 16), length, 4)
-
-            byte1 = self.sock.recv(1)
-            byte2 = self.sock.recv(1)
-            data['Present Battery Voltage'] = (ord(byte1) << 8) | ord(byte2)
-
-            if debug:
-                self.debug_file.write(byte1)
-                self.debug_file.write(byte2)
-                self.debug_file.flush()
-
-
-        def process_report_12(): # Input report #0x12
-            if debug:
-                print "process_report_12"
-    
-            if length != "\x05":
-                raise LengthPacketException(int("0x12", 16), length, 5)
-    
-            if debug:
-                print "passing..."
-            self.sock.recv(ord(length) - 2)
-
-        def process_report_13(): # Input report #0x13
-            if debug:
-                print "process_report_13"
-    
-            if length != "\x07":
-                raise LengthPacketException(int("0x13", 16), length, 7)
-    
-            if debug:
-                print "passing..."
-            self.sock.recv(ord(length) - 2)
-
-        def process_report_14(): # Input report #0x14
-            if debug:
-                print "process_report_14"
-    
-            if length != "\x0b":
-                raise LengthPacketException(int("0x14", 16), length, 11)
-    
-            if debug:
-                print "passing..."
-            self.sock.recv(ord(length) - 2)
-
-        def process_report_15(): # Input report #0x15
-            if debug:
-                print "process_report_15"
-    
-            if length != "\x04":
-                raise LengthPacketException(int("0x15", 16), length, 4)
-    
-            if debug:
-                print "passing..."
-            self.sock.recv(ord(length) - 2)
-
-        def process_report_16(): # Input report #0x16
-            if debug:
-                print "process_report_16"
-    
-            if length != "\x05":
-                raise LengthPacketException(int("0x16", 16), length, 5)
-    
-            if debug:
-                print "passing..."
-            self.sock.recv(ord(length) - 2)
-
-        def process_report_17(): # Input report #0x17
-            if debug:
-                print "process_report_17"
-    
-            if length != "\x07":
-                raise LengthPacketException(int("0x17", 16), length, 7)
-    
-            if debug:
-                print "passing..."
-            self.sock.recv(ord(length) - 2)
-
-        # report #0x18 and 0x19 are outputs reports
-
-        def process_report_1A(): # Input report #0x1A
-            if debug:
-                print "process_report_1A"
-            # Nothing to do
-
-        def process_report_1B(): # Input report #0x1B
-            if debug:
-                print "process_report_1B"
-
-            if length != "\x08":
-                raise LengthPacketException(int("0x17", 16), length, 8)
-
-
-            data['Protocol Major Version'] = self.sock.recv(2)
-            data['Protocol Minor Version'] = self.sock.recv(2)
-            data['Protocol Revision'] = self.sock.recv(2)
-    
-            if self.debug_file:
-                self.debug_file.write(data['Protocol Major Version'])
-                self.debug_file.write(data['Protocol Minor Version'])
-                self.debug_file.write(data['Protocol Revision'])
-                self.debug_file.flush()
-
-        # Below are two functions for test purpose only
-        def process_report_FD(): # Input report #0xFD
-            if debug:
-                print "process_report_FD"
-    
-            if length != "\x07":
-                raise LengthPacketException(int("0xfd", 16), length, 7)
-    
-            if debug:
-                print "passing..."
-            self.sock.recv(ord(length) - 2)
-
-        # report #FE is an output report
-
-        def process_report_FF(): # Input report #0xFF
-            if debug:
-                print "process_report_FF"
-    
-            if length != "\x06":
-                raise LengthPacketException(int("0xfd", 16), length, 6)
-    
-            if debug:
-                print "passing..."
-            self.sock.recv(ord(length) - 2)
-
-        # Get the ID of the DATA_INPUT message
-        msg_id = self.sock.recv(1)
-    
-        if self.debug_file:
-            self.debug_file.write(msg_id)
-            self.debug_file.flush()
-
-        data = {"Report ID" : msg_id}
-        try:
-            if msg_id == "\x03":
-                process_report_03()
-            elif msg_id == "\x04":
-                process_report_04()
-            elif msg_id == "\x05":
-                process_report_05()
-            elif msg_id == "\x07":
-                process_report_07()
-            elif msg_id == "\x08":
-                process_report_08()
-            elif msg_id == "\x09":
-                process_report_09()
-            elif msg_id == "\x0A":
-                process_report_0A()
-            elif msg_id == "\x0B":
-                process_report_0B()
-            elif msg_id == "\x0C":
-                process_report_0C()
-            elif msg_id == "\x0D":
-                process_report_0D()
-            elif msg_id == "\x0E":
-                process_report_0E()
-            elif msg_id == "\x0F":
-                process_report_0F()
-            elif msg_id == "\x10":
-                process_report_10()
-            elif msg_id == "\x11":
-                process_report_11()
-            elif msg_id == "\x12":
-                process_report_12()
-            elif msg_id == "\x13":
-                process_report_13()
-            elif msg_id == "\x14":
-                process_report_14()
-            elif msg_id == "\x15":
-                process_report_15()
-            elif msg_id == "\x16":
-                process_report_16()
-            elif msg_id == "\x17":
-                process_report_17()
-            elif msg_id == "\x1A":
-                process_report_1A()
-            elif msg_id == "\x1B":
-                process_report_1B()
-            # Two functions for tests purpose only
-            elif msg_id == "\xFD":
-                process_report_FD()
-            elif msg_id == "\xFF":
-                process_report_FF()
-        except LengthPacketException, (e):
-            print e
-            self.disconnect()
-            sys.exit(1)
-        except:
-            self.disconnect()
-            sys.exit(1)
+            print("time has to be a 1-byte long string")
+        return None
 
+    return b"\x02\x90" + time
+
+def report_type_enable_message(report_id, enable=1, raw=0, reserved=0):
+    if not isinstance(report_id, bytes) or len(report_id) != 1:
         if debug:
-            for x,y in data.iteritems():
-                printable_y = ""
-                if type(y) == type(1):
-                    printable_y += "%02x " % y
-                else:
-                    for i in range(len(y)):
-                        printable_y += "%02x " % ord(y[i])
-                print "%s = %s" % (x, printable_y)
+            print("report_id has to be a 1-byte long string")
+        return None
 
-            print "--------------------------------"
-    
-        return data
+    if enable != 0 and enable != 1:
+        if debug:
+            print("enable != {0|1}")
+        return None
 
-    # TODO never tested...
-    def set_idle(self, time):
-        if not isinstance(time, str) or len(time) != 1:
-            if debug:
-                print "time has to be a 1-byte long string"
-            return self.HANDSHAKE_ERR_INVALID_PARAMETER
+    if raw != 0 and raw != 1:
+        if debug:
+            print("raw != {0|1}")
+        return None
 
-        idle_msg = "\x02\x90" + time
-        self.sock.send(idle_msg)
+    if not isinstance(reserved, int) or reserved < 0 or reserved > 255:
+        if debug:
+            print("reserved has to be an int (0 <= reserved <= 255)")
+        return None
 
-        if self.debug_file:
-            self.debug_file.write(idle_msg)
-            self.debug_file.flush()
+    # two lowest bits = 0
+    reserved = reserved & 252
+    byte = reserved | (raw << 1) | enable
 
-        hs = self.sock.recv(1)
-    
-        if self.debug_file:
-            self.debug_file.write(hs)
-            self.debug_file.flush()
+    return b"\x04\xA2\x06" + report_id + struct.pack("B", byte)
 
-        return hs
+def device_local_name_message(name="Zeemote"):
+    if not isinstance(name, bytes):
+        name = name.encode("utf-8")
+    length = len(name)
 
-    # TODO never tested...
-    def set_report_type_enable(self, report_id, enable=1, raw=0, reserved=0):
-        if not isinstance(report_id, str) or len(report_id) != 1:
-            if debug:
-                print "report_id has to be a 1-byte long string"
-            return self.HANDSHAKE_ERR_INVALID_PARAMETER
+    if length > 32:
+        if debug:
+            print("Name length has to be lesser than 32 bytes")
+        return None
 
-        if enable != 0 and enable != 1:
-            if debug:
-                print "enable != {0|1}"
-            return self.HANDSHAKE_ERR_INVALID_PARAMETER
+    # The message has to be 35-bytes long (0x23 bytes)
+    return b"\x23\xA2\x18" + struct.pack("B", length) + name.ljust(32, b"\x00")
 
-        if raw != 0 and raw != 1:
-            if debug:
-                print "raw != {0|1}"
-            return self.HANDSHAKE_ERR_INVALID_PARAMETER
+def keep_alive_interval_message(interval):
+    if interval < 0 or interval > 65535:
+        if debug:
+            print("Interval has to be an integer between 0 and 65,535")
+        return None
 
-        if not isinstance(reserved, int) or reserved < 0 or reserved > 255:
-            if debug:
-                print "reserved has to be an int (0 <= reserved <= 255)"
-            return self.HANDSHAKE_ERR_INVALID_PARAMETER
+    return b"\x04\xA2\x19" + struct.pack(">H", interval)
 
-        report_msg = "\x04\xA2\x06" + report_id
+# Input reports only sent in answer to a GET_REPORT: firmware, button
+# descriptions and protocol version
+ANSWER_REPORTS = frozenset([0x03, 0x04, 0x1B])
 
-        # two lowest bits = 0
-        reserved = reserved & 252
-        byte = reserved | (raw << 1) | enable
+def get_report_message(report_id):
+    if not isinstance(report_id, bytes) or len(report_id) != 1:
+        if debug:
+            print("report_id has to be a 1-byte long string")
+        return None
 
-        report_msg += chr(byte)
+    # GET_REPORT | Input, answered with the report itself
+    return b"\x02\x41" + report_id
 
-        self.sock.send(report_msg)
 
-        if self.debug_file:
-            self.debug_file.write(report_msg)
-            self.debug_file.flush()
+#
+# Handshake of an output report
+#
+class CommandFuture():
+    """Result of an output report: the result code of its handshake.
+
+    The handshake is matched by the parser of the connection.  result()
+    reads the input meanwhile (the reports are kept for listen()), unless
+    a reader thread does it, and raises HandshakeTimeout when there is no
+    handshake timeout seconds after the report was sent.
+    """
+    def __init__(self, msg, zeemote=None, timeout=1.0):
+        self.msg = msg
+        self.zeemote = zeemote
+        self.deadline = timer() + timeout
+        self.code = None
+        self.exception = None
+        self.event = threading.Event()
+
+    def done(self):
+        if not self.event.is_set() and timer() > self.deadline:
+            self.set_exception(HandshakeTimeout(self.msg))
+        return self.event.is_set()
+
+    def set_result(self, code):
+        self.code = code
+        self.event.set()
+        zeemote = self.zeemote
+        if zeemote is not None and zeemote.capture:
+            zeemote.capture.write(CAPTURE_INPUT, b"\x01" + code, zeemote.device_id)
+
+    def set_exception(self, exception):
+        self.exception = exception
+        self.event.set()
+
+    def result(self, timeout=None):
+        """Return the result code (a HANDSHAKE_* value), waiting at most
+        timeout seconds, or up to the handshake timeout if None."""
+        if not self.done():
+            remaining = self.deadline - timer()
+            if timeout is not None:
+                remaining = min(remaining, timeout)
+            zeemote = self.zeemote
+            if zeemote is not None and zeemote.connected and zeemote.reader_thread is None:
+                zeemote.wait(self, remaining)
+            else:
+                deadline = timer() + remaining
+                while not self.done() and timer() < deadline:
+                    self.event.wait(min(0.05, max(0, deadline - timer())))
+            if not self.done():
+                raise HandshakeTimeout(self.msg)
+        if self.exception is not None:
+            raise self.exception
+        return self.code
+
+    # End of the class CommandFuture
+
+
+class ReportFuture(CommandFuture):
+    """Input report asked to the device (GET_REPORT).
+
+    result() returns the first report of the ID received.  With quiet, the
+    future is only done once no report of the ID came for quiet seconds,
+    and reports holds all of them (one button description comes per
+    button).
+    """
+    def __init__(self, msg, zeemote=None, timeout=1.0, quiet=0):
+        CommandFuture.__init__(self, msg, zeemote, timeout)
+        self.quiet = quiet
+        self.reports = []
+        self.last = None
+
+    def done(self):
+        if self.reports and not self.event.is_set():
+            now = timer()
+            if now - self.last >= self.quiet or now > self.deadline:
+                self.event.set()
+        return CommandFuture.done(self)
+
+    def set_result(self, report):
+        self.reports.append(report)
+        self.last = timer()
+        if self.code is None:
+            self.code = report
+        if not self.quiet:
+            self.event.set()
+
+    def result(self, timeout=None):
+        try:
+            return CommandFuture.result(self, timeout)
+        finally:
+            if self.zeemote is not None and self.done():
+                report_id = ord(self.msg[2:3])
+                if self.zeemote.requests.get(report_id) is self:
+                    del self.zeemote.requests[report_id]
+
+    # End of the class ReportFuture
+
+
+class ReportHandshake():
+    """Parser waiter standing for a GET_REPORT.
+
+    The device only sends a handshake for a GET_REPORT when it rejects it:
+    that handshake fails the ReportFuture with a HandshakeError.  Once the
+    report has come back no handshake will, so the waiter is done and the
+    parser gives the next handshakes to the commands sent afterwards.
+    """
+    def __init__(self, future):
+        self.future = future
+
+    def done(self):
+        return bool(self.future.reports) or self.future.done()
+
+    def set_result(self, code):
+        self.future.set_exception(HandshakeError(self.future.msg, code))
+
+    def set_exception(self, exception):
+        self.future.set_exception(exception)
+
+    # End of the class ReportHandshake
+
+
+class DeviceInfo(namedtuple('DeviceInfo', 'firmware buttons protocol')):
+    """What a device says about itself: its FirmwareReport, the
+    ButtonDescriptionReports of its buttons (by button ID) and its
+    ProtocolVersionReport (None when it doesn't answer)."""
+    __slots__ = ()
+
+    def button(self, description):
+        """Return the ID of the button described as description, or None."""
+        if not isinstance(description, bytes):
+            description = description.encode("utf-8")
+        for report in self.buttons:
+            if report.description.rstrip(b"\x00") == description:
+                return report.button_id
+        return None
+
+    def reports(self):
+        reports = [self.firmware] + list(self.buttons)
+        if self.protocol is not None:
+            reports.append(self.protocol)
+        return reports
+
+    @classmethod
+    def from_reports(cls, reports):
+        firmware = protocol = None
+        buttons = {}
+        for report in reports:
+            if report.report_id == 0x03:
+                firmware = report
+            elif report.report_id == 0x04:
+                buttons[report.button_id] = report
+            elif report.report_id == 0x1B:
+                protocol = report
+        return cls(firmware, tuple(buttons[button_id] for button_id in sorted(buttons)), protocol)
+
+    # End of the class DeviceInfo
 
-        hs = self.sock.recv(1)
-    
-        if self.debug_file:
-            self.debug_file.write(hs)
-            self.debug_file.flush()
 
-        return hs
+#
+# Zeemote listening class
+#
+class ZeemoteControl():
+    # Handshakes types
+    HANDSHAKE_SUCCESSFUL              = b"\x00"
+    HANDSHAKE_NOT_READY               = b"\x01"
+    HANDSHAKE_ERR_INVALID_REPORT_ID   = b"\x02"
+    HANDSHAKE_ERR_UNSUPPORTED_REQUEST = b"\x03"
+    HANDSHAKE_ERR_INVALID_PARAMETER   = b"\x04"
+    HANDSHAKE_ERR_UNKNOWN             = b"\x0E"
+    HANDSHAKE_ERR_FATAL               = b"\x0F"
+
+    def __init__(self, tries_nb=3, queue=None, cache=None, handshake_timeout=1.0, profile=None, info_cache=None):
+        self.number_of_tries = tries_nb
+        self.handshake_timeout = handshake_timeout
+        # Optional zeemote_queue.ReportQueue between the device and listen()
+        self.queue = queue
+        # Endpoints found by SDP, on disk; False to always run an inquiry
+        self.cache = ServiceCache() if cache is None else cache
+        # Device information, on disk; False to always ask the device
+        self.info_cache = DeviceInfoCache() if info_cache is None else info_cache
+        # address -> DeviceInfo
+        self.infos = {}
+        # report ID -> ReportFuture of a GET_REPORT
+        self.requests = {}
 
-    # TODO never tested...
-    def set_device_local_name(self, name="Zeemote"):
-        length = len(name)
+        self.connected = False
+        self.address = None
+        self.port = None
+        self.name = None
+        self.reader = None
+        self.capture = None
+        self.device_id = 0
+        # Configuration messages sent to the device, sent again by restore()
+        self.settings = OrderedDict()
+        # Reports read while waiting for a handshake
+        self.backlog = deque()
+        # zeemote_thread.ReaderThread reading the socket, if any
+        self.reader_thread = None
+        self.stats = ZeemoteStats()
+        if profile is not None:
+            self.set_profile(profile)
+        if debug:
+            try:
+                self.capture = shared_trace(CAPTURE_PREFIX % os.getpid())
+            except (IOError, OSError) as e:
+                print("No debug file for this session: ", e)
 
-        if length > 32:
-            if debug:
-                print "Name length has to be lesser than 32 bytes"
-            return self.HANDSHAKE_ERR_INVALID_PARAMETER
+    def connect(self, address=None, port=None, name=None, transport=None):
+        """Connect to the Zeemote at (address, port), or to the first found.
 
-        name_msg = "\x23\xA2\x18" + chr(length) + name
+        Without a port, the endpoints of the cache are tried first, and an
+        SDP inquiry is only run when none of them answers.
 
-        # The message has to be 35-bytes long (0x23 bytes)
-        while(len(name_msg) != 35):
-            name_msg += "\x00"
+        An already connected transport can be given instead, to talk to a
+        simulator or to replay a recorded stream.
 
-        self.sock.send(name_msg)
+        The configuration set so far (profile, idle time...) is sent to the
+        device once connected, without waiting for the handshakes.
+        """
+        try:
+            if transport is None:
+                if port is None:
+                    transport, address, port, name = self.connect_cached(address)
+                if transport is None:
+                    if port is None:
+                        address, port, name = self.discover(address)
+                    transport = RfcommTransport(address, port)
+                    if self.cache:
+                        self.cache.put(address, port, name)
+            self.sock = transport
+            self.reader = FrameReader(self.sock)
+        except (KeyboardInterrupt, BluetoothError):
+            print("Unable to connect to the Zeemote controller")
+        else:
+            # if connection succeeded
+            if address is not None:
+                print("Connected to %s (%s, %d)" % (name, address, port))
+            self.address = address
+            self.port = port
+            self.name = name
+            self.connected = True
+            if self.capture:
+                self.device_id = self.capture.add_device(
+                    address or "transport %d" % len(self.capture.devices))
+            try:
+                self.restore(wait=False)
+            except BluetoothError:
+                print("Unable to configure the Zeemote controller")
+                self.close_transport()
+
+    def connect_cached(self, address=None):
+        """Try the cached endpoints of address (of any device if None).
+
+        Return the transport, address, port and name of the first one
+        which accepts the connection; endpoints which don't are removed
+        from the cache.
+        """
+        for host, port, name in (self.cache.get(address) if self.cache else ()):
+            try:
+                transport = RfcommTransport(host, port)
+            except BluetoothError:
+                self.cache.forget(host)
+            else:
+                self.cache.put(host, port, name)
+                return transport, host, port, name
+        return None, address, None, None
 
-        if self.debug_file:
-            self.debug_file.write(name_msg)
-            self.debug_file.flush()
+    def discover(self, address=None):
+        """Return the (address, port, name) of the first Zeemote found."""
+        if debug:
+            print("Trying to find a Zeemote device...")
+        service_matches = []
+        while(self.number_of_tries > 0 and len(service_matches) == 0):
+            self.number_of_tries -= 1
+            service_matches = find_service( uuid = ZEEMOTE_UUID, address = address )
 
+        if len(service_matches) == 0:
+            print("Couldn't find any Zeemote device")
+            raise Exception("No zeemote device found")
 
-        # FIXME This handle a timeout exception, but a timer is more appropriate here.
-        # The documentation says:
-        # "If the device does not recognize this packet of this type, it should be ignored silently"
-        # So make sure we're not wasting our time
+        first_match = service_matches[0]
+        if debug:
+            print("One Zeemote device found: %s (%s)" % (first_match["name"], first_match["host"]))
+        return first_match["host"], first_match["port"], first_match["name"]
+
+    def disconnect(self):
+        if self.connected:
+            self.close_transport()
+            print("Disconnected from the Zeemote controller")
+        if self.capture:
+            try:
+                self.capture.close()
+            except:
+                pass
+            self.capture = None
+
+    def close_transport(self):
+        """Close the link to the device, but not the debug capture."""
+        self.connected = False
         try:
-            hs = self.sock.recv(1)
-    
-            if self.debug_file:
-                self.debug_file.write(hs)
-                self.debug_file.flush()
-        except:
+            self.sock.close()
+        except BluetoothError:
             pass
+        if self.reader is not None:
+            self.reader.parser.fail(BluetoothError("Connection to the Zeemote closed"))
+
+    def link_lost(self):
+        """Reconnect after an error on the link, while tries are left.
+
+        Otherwise, or when the device can't be reached again, the
+        controller ends up disconnected: callers see the end of the
+        stream instead of reading a dead socket again.
+        """
+        self.stats.link_errors += 1
+        if self.address is None or self.number_of_tries <= 0:
+            # A transport given to connect() can't be opened again, and
+            # the tries are exhausted
+            self.disconnect()
+            return
+        self.number_of_tries -= 1
+        self.close_transport()
+        if debug:
+            print("Reconnecting...")
+        self.stats.reconnects += 1
+        # Straight to the same device, through the cache
+        self.connect(self.address)
+
+    def process_frame(self, frame):
+        if self.capture:
+            self.capture.write(CAPTURE_INPUT, frame, self.device_id)
+
+        if log.isEnabledFor(TRACE):
+            log.log(TRACE, "Frame %s (%d syscalls)", hexlify(frame).decode("ascii"), self.reader.frame_syscalls)
+
+        stats = self.stats
+        parser = self.reader.parser
+        if parser.errors:
+            log.warning("Lost sync with the Zeemote, %d bytes skipped", parser.skipped)
+            stats.length_errors += parser.errors
+            stats.skipped_bytes += parser.skipped
+            parser.errors = parser.skipped = 0
+        stats.syscalls += self.reader.frame_syscalls
+        backlog = parser.end - parser.start
+        if backlog > stats.max_backlog:
+            stats.max_backlog = backlog
+
+        start = timer()
+        try:
+            report = decode_report(frame)
+        except (LengthPacketException, struct.error) as e:
+            # Only frames which didn't come through a resyncing parser
+            log.warning("%s", e)
+            stats.length_errors += 1
+            report = UnknownReport(ord(frame[2:3]) if len(frame) > 2 else None, frame[3:])
 
-        return hs
+        if self.requests:
+            future = self.requests.get(report.report_id)
+            if future is not None:
+                future.set_result(report)
 
+        stats.record(report.report_id, len(frame), timer() - start)
+        if report.__class__ is UnknownReport:
+            stats.unknown_reports += 1
 
-    # FIXME doesn't work
-    def set_keep_alive_interval(self, interval):
-        if interval < 0 or interval > 65535:
-            if debug:
-                print "Interval has to be an integer between 0 and 65,535"
-            return self.HANDSHAKE_ERR_INVALID_PARAMETER
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%r", report)
 
-        interval_msg = "\x04\xA2\x19"
+        return report
 
-        byte1 = (interval >> 8)
-        byte2 = (interval & 255)
+    def listen(self):
+        if self.queue is not None:
+            while len(self.queue) == 0 and self.connected:
+                self.pump(None)
+            return self.queue.get()
 
-        interval_msg += chr(byte1) + chr(byte2)
+        if self.backlog:
+            return self.backlog.popleft()
+        try:
+            frame = self.reader.read_frame()
+        except KeyboardInterrupt:
+            self.disconnect()
+            return None
+        except BluetoothError:
+            self.link_lost()
+            return None
 
-        self.sock.send(interval_msg)
+        return self.process_frame(frame)
+
+    def iter_reports(self):
+        """Yield the reports already received, without blocking."""
+        while self.backlog:
+            yield self.backlog.popleft()
+        frame = self.reader.next_frame()
+        while frame is not None:
+            yield self.process_frame(frame)
+            frame = self.reader.next_frame()
+
+    def listen_many(self, max_n=64, timeout=None):
+        """Return up to max_n reports in one go.
+
+        Only waits (at most timeout seconds, forever if None) when nothing
+        has been received yet; otherwise the socket is drained with a
+        single recv() and every complete report is returned.  Reports over
+        max_n are kept for the next call.
+        """
+        if self.queue is not None:
+            self.pump(0 if len(self.queue) else timeout)
+            return self.queue.get_many(max_n)
+        return self.receive(max_n, timeout)
+
+    def pump(self, timeout=0):
+        """Move every report received so far into the queue."""
+        self.queue.extend(self.receive(sys.maxsize, timeout))
+
+    def current_state(self):
+        """Snapshot of the controller state, without consuming the queue.
+
+        Only reads the state: it is as recent as the last listen(),
+        listen_many() or pump(), call pump() first to include the reports
+        still in the socket.
+        """
+        if self.queue is None:
+            raise ValueError("current_state() needs a ReportQueue, see ZeemoteControl(queue=...)")
+        return self.queue.state.snapshot()
+
+    def receive(self, max_n, timeout):
+        reports = list(islice(self.iter_reports(), max_n))
+        # Once disconnected, only what was buffered is left
+        if len(reports) < max_n and self.connected:
+            try:
+                if self.reader.wait(0 if reports else timeout):
+                    self.reader.fill()
+            except KeyboardInterrupt:
+                self.disconnect()
+                return reports
+            except BluetoothError:
+                self.link_lost()
+                return reports
+            reports.extend(islice(self.iter_reports(), max_n - len(reports)))
+        return reports
+
+    def remember(self, msg):
+        """Keep the last configuration message of its kind for restore()."""
+        if msg[1:2] == b"\x90":
+            key = msg[1:2]
+        elif msg[1:3] == b"\xA2\x06":
+            # One report type enable per report ID
+            key = msg[1:4]
+        else:
+            key = msg[1:3]
+        self.settings[key] = msg
+
+    def restore(self, wait=True):
+        """Send the configuration again, after a reconnection.
+
+        Return the result codes (None when there was no handshake), or the
+        CommandFutures without wait.
+        """
+        futures = [self.command(msg) for msg in list(self.settings.values())]
+        if not wait:
+            return futures
+        codes = []
+        for future in futures:
+            try:
+                codes.append(future.result())
+            except HandshakeTimeout as e:
+                log.warning("%s", e)
+                codes.append(None)
+        return codes
+
+    def command(self, msg):
+        """Send an output report without waiting for its handshake.
+
+        Return a CommandFuture; several commands can be sent before
+        waiting for any of them, their handshakes come back in order.
+        """
+        future = CommandFuture(msg, self, self.handshake_timeout)
+        self.reader.parser.expect(future)
+        self.sock.send(msg)
+
+        if self.capture:
+            self.capture.write(CAPTURE_OUTPUT, msg, self.device_id)
+
+        return future
+
+    def failed(self, code):
+        """Return a CommandFuture already completed with code."""
+        future = CommandFuture(None)
+        future.set_result(code)
+        return future
+
+    def wait(self, future, timeout):
+        """Read the input until future is done, for at most timeout seconds.
+
+        The reports read meanwhile are kept for listen().
+        """
+        deadline = timer() + timeout
+        reader = self.reader
+        while future is None or not future.done():
+            frame = reader.next_frame()
+            if frame is not None:
+                report = self.process_frame(frame)
+                if self.queue is not None:
+                    self.queue.put(report)
+                else:
+                    self.backlog.append(report)
+                continue
+            remaining = deadline - timer()
+            if remaining <= 0:
+                break
+            # Short waits: a future may become done with time only
+            if reader.wait(min(remaining, 0.05)):
+                reader.fill()
+
+    def request_report(self, report_id, quiet=0):
+        """Ask the device for an information report (ANSWER_REPORTS),
+        return a ReportFuture.  Its result() raises HandshakeError when
+        the device rejects the request.
+        """
+        msg = get_report_message(report_id)
+        if msg is None:
+            return self.failed(self.HANDSHAKE_ERR_INVALID_PARAMETER)
+        if ord(report_id) not in ANSWER_REPORTS:
+            # Streamed reports can't be told apart from an answer
+            return self.failed(self.HANDSHAKE_ERR_INVALID_REPORT_ID)
+
+        future = ReportFuture(msg, self, self.handshake_timeout, quiet)
+        self.requests[ord(report_id)] = future
+        # Keeps the handshakes of the other commands in order
+        self.reader.parser.expect(ReportHandshake(future))
+        self.sock.send(msg)
+
+        if self.capture:
+            self.capture.write(CAPTURE_OUTPUT, msg, self.device_id)
+
+        return future
+
+    def device_info(self, refresh=False):
+        """Return the DeviceInfo of the connected device.
+
+        It is asked once per device: later calls return it from memory.
+        The cache on disk is used as long as the device reports the same
+        firmware, so only the firmware report is asked after a restart.
+        When the button descriptions don't come, what was received is
+        returned but not kept, and asked again by the next call; a device
+        which doesn't give its protocol version has a protocol of None.
+        Raises HandshakeTimeout when the device doesn't answer, or
+        HandshakeError when it rejects the request.
+        """
+        address = self.address
+        if not refresh and address in self.infos:
+            return self.infos[address]
+
+        firmware = self.request_report(b"\x03").result()
+        firmware_frame = encode_report(firmware)
+        frames = None
+        if self.info_cache and not refresh:
+            frames = self.info_cache.get(address, firmware_frame)
+
+        complete = True
+        if frames is not None:
+            info = DeviceInfo.from_reports([firmware] + [decode_report(frame) for frame in frames])
+        else:
+            buttons = self.request_report(b"\x04", quiet=0.1)
+            protocol = self.request_report(b"\x1B")
+            reports = [firmware]
+            for future in (buttons, protocol):
+                try:
+                    future.result()
+                except (HandshakeTimeout, HandshakeError) as e:
+                    log.warning("%s", e)
+                    # Without a protocol version, the information is
+                    # complete all the same
+                    if future is buttons:
+                        complete = False
+                reports.extend(future.reports)
+            info = DeviceInfo.from_reports(reports)
+            # A partial answer is not saved: it would be reused until the
+            # firmware changes
+            if complete and self.info_cache and address is not None:
+                self.info_cache.put(address, firmware_frame, [encode_report(report) for report in info.reports()[1:]])
+
+        if complete:
+            self.infos[address] = info
+        return info
+
+    def set_profile(self, profile):
+        """Enable the reports of a zeemote_profile.ReportProfile and disable
+        the others, now if connected and after each reconnection.
+
+        Return the CommandFutures of the messages sent.
+        """
+        futures = []
+        for msg in profile.messages():
+            self.remember(msg)
+            if self.connected:
+                futures.append(self.command(msg))
+        return futures
 
-        if self.debug_file:
-            self.debug_file.write(interval_msg)
-            self.debug_file.flush()
+    def set_idle(self, time):
+        idle_msg = idle_message(time)
+        if idle_msg is None:
+            return self.failed(self.HANDSHAKE_ERR_INVALID_PARAMETER)
 
-        hs = self.sock.recv(1)
-    
-        if self.debug_file:
-            self.debug_file.write(hs)
-            self.debug_file.flush()
+        self.remember(idle_msg)
+        return self.command(idle_msg)
 
-        return hs
+    def set_report_type_enable(self, report_id, enable=1, raw=0, reserved=0):
+        report_msg = report_type_enable_message(report_id, enable, raw, reserved)
+        if report_msg is None:
+            return self.failed(self.HANDSHAKE_ERR_INVALID_PARAMETER)
 
+        self.remember(report_msg)
+        return self.command(report_msg)
 
+    def set_device_local_name(self, name="Zeemote"):
+        name_msg = device_local_name_message(name)
+        if name_msg is None:
+            return self.failed(self.HANDSHAKE_ERR_INVALID_PARAMETER)
 
+        # The documentation says:
+        # "If the device does not recognize this packet of this type, it should be ignored silently"
+        # so the result of the future may well be a HandshakeTimeout
+        self.remember(name_msg)
+        return self.command(name_msg)
 
+    def set_keep_alive_interval(self, interval):
+        interval_msg = keep_alive_interval_message(interval)
+        if interval_msg is None:
+            return self.failed(self.HANDSHAKE_ERR_INVALID_PARAMETER)
 
+        self.remember(interval_msg)
+        return self.command(interval_msg)
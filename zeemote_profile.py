@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+# 
+# LICENSE
+# 
+# Copyright (c) 2010, University College Dublin, National University of
+# Ireland, Dublin
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# - Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# 
+# - Neither the name University College Dublin, National University of
+# Ireland, Dublin nor the names of its contributors may be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# Report subscription profiles: the input reports an application needs,
+# the device being told to stop sending the other ones
+#
+
+from __future__ import print_function
+
+import struct
+
+import zeemote_listener as zl
+
+# Input reports the device streams, which can be enabled or disabled.  The
+# device information reports (0x03, 0x04, 0x1B) only come as answers.
+STREAM_REPORTS = (0x05, 0x07) + tuple(range(0x08, 0x18))
+
+# Resolutions of the 2-axis joystick
+JOYSTICK_8  = 0x08
+JOYSTICK_16 = 0x09
+JOYSTICK_32 = 0x0A
+
+
+class ReportProfile():
+    """Input reports wanted from the device.
+
+    Every report of STREAM_REPORTS not in reports is disabled, and raw
+    mode is off for the reports not in raw.  Profiles are applied with
+    ZeemoteControl.set_profile(), or given to its constructor:
+
+        zeemote = ZeemoteControl(profile=ReportProfile([0x07, JOYSTICK_8]))
+    """
+    def __init__(self, reports, raw=()):
+        self.reports = frozenset(reports)
+        self.raw = frozenset(raw)
+        if not self.raw <= self.reports:
+            raise ValueError("raw reports have to be enabled too")
+
+    def messages(self):
+        """Return the report type enable messages of the profile, in one
+        batch for all the streamed reports."""
+        return [zl.report_type_enable_message(struct.pack("B", report_id),
+                                              int(report_id in self.reports),
+                                              int(report_id in self.raw))
+                for report_id in STREAM_REPORTS]
+
+    def __or__(self, other):
+        return ReportProfile(self.reports | other.reports, self.raw | other.raw)
+
+    def __repr__(self):
+        return "ReportProfile([%s])" % ", ".join("0x%02X" % report_id for report_id in sorted(self.reports))
+
+    # End of the class ReportProfile
+
+
+# Common profiles
+BUTTONS  = ReportProfile([0x07])
+JOYSTICK = ReportProfile([0x07, JOYSTICK_8])
+GAMEPAD  = ReportProfile([0x07, JOYSTICK_8, 0x11])
+# Everything the device can stream
+FULL     = ReportProfile(STREAM_REPORTS)
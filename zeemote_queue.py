@@ -0,0 +1,186 @@
+#!/usr/bin/python
+
+# 
+# LICENSE
+# 
+# Copyright (c) 2010, University College Dublin, National University of
+# Ireland, Dublin
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# - Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# 
+# - Neither the name University College Dublin, National University of
+# Ireland, Dublin nor the names of its contributors may be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# Bounded report queue, where joystick samples waiting for a slow consumer
+# are merged or dropped, and the controller state it keeps up to date
+#
+
+from __future__ import print_function
+
+from collections import deque, namedtuple
+
+import zeemote_listener as zl
+
+# Policies for the joystick samples
+LATEST      = "latest"       # only the last position of each joystick waits
+DROP_OLDEST = "drop-oldest"  # at most maxlen positions wait, oldest dropped
+
+# Reports which are samples of a continuous position
+SAMPLE_CLASSES = frozenset([zl.JoystickReport, zl.Joystick3Report, zl.AxisReport])
+
+
+State = namedtuple('State', 'x y joystick_id report_id keys voltage reports')
+
+class ControllerState():
+    """Last known state of the controller, updated report by report."""
+    __slots__ = ('x', 'y', 'joystick_id', 'report_id', 'keys', 'voltage', 'reports')
+
+    def __init__(self):
+        self.x = 0
+        self.y = 0
+        self.joystick_id = None
+        self.report_id = None
+        self.keys = frozenset()
+        self.voltage = None
+        self.reports = 0
+
+    def update(self, report):
+        self.reports += 1
+        cls = report.__class__
+        if cls is zl.JoystickReport or cls is zl.Joystick3Report:
+            self.x = report.x
+            self.y = report.y
+            self.joystick_id = report.joystick_id
+            self.report_id = report.report_id
+        elif cls is zl.KeyReport:
+            self.keys = frozenset(report.pressed)
+        elif cls is zl.BatteryReport:
+            self.voltage = report.voltage
+
+    def snapshot(self):
+        return State(self.x, self.y, self.joystick_id, self.report_id,
+                     self.keys, self.voltage, self.reports)
+
+    # End of the class ControllerState
+
+
+class ReportQueue():
+    """FIFO of reports where joystick samples can be merged or dropped.
+
+    Buttons, device information and any other report are never dropped.
+    Joystick samples follow the policy: with LATEST a new sample replaces
+    the one of the same joystick still waiting (keeping its place in the
+    queue), with DROP_OLDEST at most maxlen samples wait.  Every report
+    updates state, so current positions are known even when samples are
+    merged.  Give the queue to ZeemoteControl to use it:
+
+        zeemote = ZeemoteControl(queue=ReportQueue())
+    """
+    def __init__(self, maxlen=256, policy=LATEST):
+        if policy not in (LATEST, DROP_OLDEST):
+            raise ValueError("Unknown policy %r" % policy)
+        self.maxlen = maxlen
+        self.policy = policy
+        self.items = deque()
+        self.state = ControllerState()
+
+        # LATEST: (report ID, joystick ID) -> waiting sample; the items are
+        # then these keys, plain tuples
+        self.latest = {}
+        # DROP_OLDEST: samples in items, and how many of the first ones are
+        # dropped
+        self.samples = 0
+        self.to_drop = 0
+
+        self.coalesced = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.items) - self.to_drop
+
+    def put(self, report):
+        self.state.update(report)
+        if report.__class__ not in SAMPLE_CLASSES:
+            self.items.append(report)
+        elif self.policy == LATEST:
+            key = (report.report_id, report.joystick_id)
+            if key in self.latest:
+                self.coalesced += 1
+            else:
+                self.items.append(key)
+            self.latest[key] = report
+        else:
+            self.items.append(report)
+            self.samples += 1
+            if self.samples - self.to_drop > self.maxlen:
+                self.to_drop += 1
+                self.dropped += 1
+                if self.to_drop >= self.maxlen:
+                    self.compact()
+
+    def extend(self, reports):
+        for report in reports:
+            self.put(report)
+
+    def compact(self):
+        """Really remove the samples to drop."""
+        items = deque()
+        for item in self.items:
+            if self.to_drop and item.__class__ in SAMPLE_CLASSES:
+                self.to_drop -= 1
+                self.samples -= 1
+            else:
+                items.append(item)
+        self.items = items
+
+    def get(self):
+        """Return the oldest report waiting, or None."""
+        items = self.items
+        while items:
+            item = items.popleft()
+            if type(item) is tuple:
+                return self.latest.pop(item)
+            if item.__class__ in SAMPLE_CLASSES:
+                self.samples -= 1
+                if self.to_drop:
+                    self.to_drop -= 1
+                    continue
+            return item
+        return None
+
+    def get_many(self, max_n):
+        reports = []
+        while len(reports) < max_n:
+            report = self.get()
+            if report is None:
+                break
+            reports.append(report)
+        return reports
+
+    # End of the class ReportQueue
@@ -0,0 +1,177 @@
+#!/usr/bin/python
+
+# 
+# LICENSE
+# 
+# Copyright (c) 2010, University College Dublin, National University of
+# Ireland, Dublin
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# - Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# 
+# - Neither the name University College Dublin, National University of
+# Ireland, Dublin nor the names of its contributors may be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# Controller state published in shared memory, for local processes which
+# want the position of the joystick or the keys held without talking to
+# the device themselves
+#
+
+from __future__ import print_function
+
+import mmap
+import os
+import struct
+import tempfile
+import time
+from collections import namedtuple
+
+import zeemote_listener as zl
+from zeemote_queue import ControllerState
+from zeemote_supervisor import CONNECTING, CONNECTED, DISCONNECTED, CLOSED
+
+# Layout of the segment: a header, the sequence counter, then the state
+HEADER  = struct.Struct("<4sB3x")
+SEQ     = struct.Struct("<Q")
+PAYLOAD = struct.Struct("<iiBBHQQdB")
+MAGIC   = b"ZSHM"
+VERSION = 1
+SEQ_OFFSET     = HEADER.size
+PAYLOAD_OFFSET = SEQ_OFFSET + SEQ.size
+SIZE = PAYLOAD_OFFSET + PAYLOAD.size
+
+# Connection states, by code
+STATES = (DISCONNECTED, CONNECTING, CONNECTED, CLOSED)
+
+# joystick_id and report_id when no joystick report was received
+NONE = 0xFF
+
+SharedState = namedtuple('SharedState', 'x y joystick_id report_id voltage keys reports time state seq')
+
+
+def default_path(name="zeemote"):
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, name)
+
+def key_mask(keys):
+    """Bitmask of the key codes (0 to 63) in keys."""
+    return zl.key_mask(keys) & 0xFFFFFFFFFFFFFFFF
+
+
+class StatePublisher():
+    """Write the state of a controller in a small shared memory segment.
+
+    Give it every report, and the connection states of a supervisor:
+
+        publisher = StatePublisher()
+        supervisor.on_state(publisher.set_state)
+        for report in supervisor:
+            publisher.update(report)
+
+    Each write is framed by two increments of a sequence counter (a
+    seqlock): the counter is odd while the state is being written.
+    """
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self.state = ControllerState()
+        self.connection = DISCONNECTED
+        self.seq = 0
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, SIZE)
+            self.map = mmap.mmap(fd, SIZE)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION)
+        self.publish()
+
+    def update(self, report):
+        self.state.update(report)
+        self.publish()
+
+    def set_state(self, state):
+        self.connection = state
+        self.publish()
+
+    def publish(self):
+        state = self.state
+        self.seq += 1
+        SEQ.pack_into(self.map, SEQ_OFFSET, self.seq)
+        PAYLOAD.pack_into(self.map, PAYLOAD_OFFSET,
+                          state.x, state.y,
+                          NONE if state.joystick_id is None else state.joystick_id,
+                          NONE if state.report_id is None else state.report_id,
+                          state.voltage or 0, key_mask(state.keys), state.reports,
+                          time.time(), STATES.index(self.connection))
+        self.seq += 1
+        SEQ.pack_into(self.map, SEQ_OFFSET, self.seq)
+
+    def close(self, unlink=True):
+        self.set_state(CLOSED)
+        self.map.close()
+        if unlink:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    # End of the class StatePublisher
+
+
+class StateReader():
+    """Read the state published by a StatePublisher, from any process.
+
+    read() makes no system call: it copies the state out of the mapping
+    and starts again if the sequence counter shows it was being written.
+    """
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        with open(self.path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), SIZE, access=mmap.ACCESS_READ)
+        magic, version = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.map.close()
+            raise ValueError("%s is not a Zeemote state segment" % self.path)
+
+    def read(self, tries=1000):
+        """Return a consistent SharedState, or None if the publisher kept
+        writing (or died while writing) during tries attempts."""
+        for i in range(tries):
+            seq = SEQ.unpack_from(self.map, SEQ_OFFSET)[0]
+            if seq & 1:
+                continue
+            values = PAYLOAD.unpack_from(self.map, PAYLOAD_OFFSET)
+            if SEQ.unpack_from(self.map, SEQ_OFFSET)[0] == seq:
+                return SharedState(*(values[:8] + (STATES[values[8]], seq)))
+        return None
+
+    def close(self):
+        self.map.close()
+
+    # End of the class StateReader
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+
+# 
+# LICENSE
+# 
+# Copyright (c) 2010, University College Dublin, National University of
+# Ireland, Dublin
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# - Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# 
+# - Neither the name University College Dublin, National University of
+# Ireland, Dublin nor the names of its contributors may be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# Joystick signal processing on batches of samples: sign conversion,
+# calibration, radial dead zone, direction quantization and exponential
+# smoothing.  Uses NumPy when it is installed, plain Python otherwise.
+#
+
+from __future__ import division
+
+import math
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import zeemote_listener as zl
+
+# Full scale and struct type of the axis readings of each 2-axis report
+AXIS_FORMATS = {
+    0x08: (127, "b"),
+    0x09: (32767, "h"),
+    0x0A: (2147483647, "i"),
+    0x12: (127, "b"),
+    0x13: (32767, "h"),
+    0x14: (2147483647, "i"),
+}
+
+# Direction codes: sectors counted clockwise from the right (the Y axis
+# points down), CENTER inside the dead zone
+CENTER = -1
+DIRECTIONS_4 = ("right", "down", "left", "up")
+DIRECTIONS_8 = ("right", "down-right", "down", "down-left",
+                "left", "up-left", "up", "up-right")
+
+
+class Calibration():
+    """Center and half range of the two axes of a device, in full scale
+    units (-1.0 to 1.0 for an ideal joystick)."""
+    def __init__(self, center_x=0.0, center_y=0.0, range_x=1.0, range_y=1.0):
+        self.center_x = center_x
+        self.center_y = center_y
+        self.range_x = range_x
+        self.range_y = range_y
+
+    @classmethod
+    def from_samples(cls, rest_x, rest_y, extent_x, extent_y):
+        """Calibrate from samples taken at rest and from samples covering
+        the whole extent of the joystick (all normalized)."""
+        center_x = sum(rest_x) / len(rest_x)
+        center_y = sum(rest_y) / len(rest_y)
+        range_x = max(abs(max(extent_x) - center_x), abs(min(extent_x) - center_x)) or 1.0
+        range_y = max(abs(max(extent_y) - center_y), abs(min(extent_y) - center_y)) or 1.0
+        return cls(center_x, center_y, range_x, range_y)
+
+    # End of the class Calibration
+
+
+class JoystickProcessor():
+    """Turn batches of raw axis readings into calibrated positions.
+
+    process() returns the x and y positions (floats, -1.0 to 1.0) and the
+    direction codes of the samples, as NumPy arrays when use_numpy (the
+    default when NumPy is available), lists otherwise.  The steps are:
+    calibration, radial dead zone (positions inside dead_zone are 0, the
+    others are rescaled to start from 0 at its edge), exponential
+    smoothing (smoothing is the weight of the previous position, 0 turns
+    it off) and quantization into 4 or 8 directions.  A sample inside the
+    dead zone is CENTER even while its smoothed position is still coming
+    back to 0.  The smoothing carries over from one batch to the next.
+    """
+    def __init__(self, calibration=None, dead_zone=0.1, directions=8, smoothing=0.0, use_numpy=None):
+        if directions not in (4, 8):
+            raise ValueError("directions has to be 4 or 8")
+        if not 0.0 <= smoothing < 1.0:
+            raise ValueError("smoothing has to be in [0, 1)")
+        self.calibration = calibration or Calibration()
+        self.dead_zone = dead_zone
+        self.directions = directions
+        self.smoothing = smoothing
+        self.use_numpy = numpy is not None if use_numpy is None else use_numpy
+        self.last = (0.0, 0.0)
+
+    def process_reports(self, reports):
+        """Process the joystick reports of a batch, in their order.  The
+        resolutions can be mixed: each sample is read at its own scale."""
+        reports = [report for report in reports if report.report_id in AXIS_FORMATS]
+        if not reports:
+            return self.process([], [], 1)
+        scales = [AXIS_FORMATS[report.report_id][0] for report in reports]
+        if scales.count(scales[0]) == len(scales):
+            return self.process([report.x for report in reports], [report.y for report in reports], scales[0])
+        # Mixed resolutions: bring every sample to full scale 1
+        return self.process([float(report.x) / scale for report, scale in zip(reports, scales)],
+                            [float(report.y) / scale for report, scale in zip(reports, scales)], 1.0)
+
+    def process_frames(self, frames, signed=True):
+        """Process raw frames of one 2-axis joystick report type without
+        decoding them into reports.  With signed False, the readings are
+        taken as unsigned values centered on half their range."""
+        if not frames:
+            return self.process([], [], 1)
+        scale, code = AXIS_FORMATS[ord(frames[0][2:3])]
+        size = len(frames[0])
+        if self.use_numpy:
+            kind = ">%s%d" % ("i" if signed else "u", len(frames[0]) // 2 - 2)
+            records = numpy.frombuffer(b"".join(frames), numpy.dtype([
+                ("header", "u1", 4), ("x", kind), ("y", kind)]))
+            xs = records["x"].astype(numpy.float64)
+            ys = records["y"].astype(numpy.float64)
+        else:
+            layout = struct.Struct(">4x" + (code if signed else code.upper()) * 2)
+            data = b"".join(frames)
+            pairs = [layout.unpack_from(data, offset) for offset in range(0, len(data), size)]
+            xs = [pair[0] for pair in pairs]
+            ys = [pair[1] for pair in pairs]
+        if not signed:
+            xs = self.center(xs, scale + 1)
+            ys = self.center(ys, scale + 1)
+        return self.process(xs, ys, scale)
+
+    def center(self, values, half):
+        if self.use_numpy:
+            return values - half
+        return [value - half for value in values]
+
+    def process(self, xs, ys, scale):
+        if self.use_numpy:
+            return self.process_numpy(numpy.asarray(xs, numpy.float64), numpy.asarray(ys, numpy.float64), scale)
+        return self.process_python(xs, ys, scale)
+
+    def process_numpy(self, xs, ys, scale):
+        c = self.calibration
+        xs = numpy.clip((xs / scale - c.center_x) / c.range_x, -1.0, 1.0)
+        ys = numpy.clip((ys / scale - c.center_y) / c.range_y, -1.0, 1.0)
+
+        radius = numpy.hypot(xs, ys)
+        outside = radius > self.dead_zone
+        gain = numpy.zeros_like(radius)
+        gain[outside] = numpy.minimum(1.0, (radius[outside] - self.dead_zone) / (1.0 - self.dead_zone)) / radius[outside]
+        xs = xs * gain
+        ys = ys * gain
+
+        if self.smoothing and len(xs):
+            xs = self.smooth_numpy(xs, self.last[0])
+            ys = self.smooth_numpy(ys, self.last[1])
+        if len(xs):
+            self.last = (float(xs[-1]), float(ys[-1]))
+
+        sector = 2 * math.pi / self.directions
+        codes = numpy.rint(numpy.arctan2(ys, xs) / sector).astype(numpy.int64) % self.directions
+        # From the samples: a smoothed position never quite reaches 0
+        codes[~outside] = CENTER
+        return xs, ys, codes
+
+    def smooth_numpy(self, values, previous):
+        # s[n] = (1 - k) * v[n] + k * s[n - 1] is, with the powers of k:
+        # s[n] = k^(n+1) * previous + (1 - k) * k^n * sum(v[i] / k^i, i <= n)
+        # Chunks keep the powers of k within the range of the floats.
+        k = self.smoothing
+        chunk = max(1, int(300 / -math.log10(k))) if k else len(values)
+        out = numpy.empty_like(values)
+        for start in range(0, len(values), chunk):
+            part = values[start:start + chunk]
+            powers = k ** numpy.arange(len(part))
+            smoothed = powers * ((1 - k) * numpy.cumsum(part / powers) + k * previous)
+            out[start:start + chunk] = smoothed
+            previous = smoothed[-1]
+        return out
+
+    def process_python(self, xs, ys, scale):
+        c = self.calibration
+        dead_zone = self.dead_zone
+        k = self.smoothing
+        last_x, last_y = self.last
+        sector = 2 * math.pi / self.directions
+        out_x = []
+        out_y = []
+        codes = []
+        for x, y in zip(xs, ys):
+            x = min(1.0, max(-1.0, (x / scale - c.center_x) / c.range_x))
+            y = min(1.0, max(-1.0, (y / scale - c.center_y) / c.range_y))
+            radius = math.hypot(x, y)
+            outside = radius > dead_zone
+            if outside:
+                gain = min(1.0, (radius - dead_zone) / (1.0 - dead_zone)) / radius
+                x *= gain
+                y *= gain
+            else:
+                x = y = 0.0
+            if k:
+                x = (1 - k) * x + k * last_x
+                y = (1 - k) * y + k * last_y
+            last_x, last_y = x, y
+            out_x.append(x)
+            out_y.append(y)
+            if not outside:
+                # From the sample: a smoothed position never quite reaches 0
+                codes.append(CENTER)
+            else:
+                codes.append(int(round(math.atan2(y, x) / sector)) % self.directions)
+        self.last = (last_x, last_y)
+        return out_x, out_y, codes
+
+    # End of the class JoystickProcessor
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+# 
+# LICENSE
+# 
+# Copyright (c) 2010, University College Dublin, National University of
+# Ireland, Dublin
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# - Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# 
+# - Neither the name University College Dublin, National University of
+# Ireland, Dublin nor the names of its contributors may be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# Zeemote device simulator: plays the device side of ZCP over any stream
+# socket, to exercise the library without hardware
+#
+
+from __future__ import print_function
+
+import argparse
+import math
+import os
+import random
+import select
+import socket
+import struct
+import threading
+import time
+
+import zeemote_listener as zl
+
+
+# Handshake result codes
+SUCCESSFUL = zl.ZeemoteControl.HANDSHAKE_SUCCESSFUL
+ERR_INVALID_REPORT_ID = zl.ZeemoteControl.HANDSHAKE_ERR_INVALID_REPORT_ID
+ERR_UNSUPPORTED_REQUEST = zl.ZeemoteControl.HANDSHAKE_ERR_UNSUPPORTED_REQUEST
+ERR_INVALID_PARAMETER = zl.ZeemoteControl.HANDSHAKE_ERR_INVALID_PARAMETER
+
+
+def synthetic_reports(seed=None):
+    """Endless stream of plausible reports.
+
+    Mostly 8-bit joystick reports drawing circles, with some 16 and 32-bit
+    ones, a button pressed or released every 40 reports and the battery
+    voltage every 250.
+    """
+    rng = random.Random(seed)
+    n = 0
+    held = []
+    while True:
+        n += 1
+        if n % 250 == 0:
+            yield zl.BatteryReport(0x11, 2800 + rng.randint(0, 400))
+        elif n % 40 == 0:
+            key = rng.randint(0, 3)
+            if key in held:
+                held.remove(key)
+            elif len(held) < 6:
+                held.append(key)
+            yield zl.KeyReport(0x07, tuple(held) + (zl.KEY_NONE,) * (6 - len(held)))
+        else:
+            angle = n * 0.05
+            x = math.cos(angle)
+            y = math.sin(angle)
+            if n % 10 == 1:
+                yield zl.JoystickReport(0x09, 0, 0, int(x * 32767), int(y * 32767))
+            elif n % 10 == 2:
+                yield zl.JoystickReport(0x0A, 0, 0, int(x * 2147483647), int(y * 2147483647))
+            else:
+                yield zl.JoystickReport(0x08, 0, 0, int(x * 127), int(y * 127))
+
+
+class ZcpSimulator():
+    """Device side of the Zeemote Controller Protocol.
+
+    Sends the frames of reports (synthetic_reports() by default) at rate
+    reports per second (as fast as possible if 0), burst frames per send.
+    Output reports received from the host are answered with handshakes:
+    set idle (0x90), report type enable (0x06), device local name (0x18)
+    and keep alive interval (0x19) are understood and update the state of
+    the simulated device, disabled reports are not sent anymore.
+    GET_REPORT (0x41) of the device information reports is answered with
+    the reports themselves.  With
+    drop_after, the connection is closed after that many reports to test
+    reconnections.
+    """
+    def __init__(self, sock, rate=100.0, reports=None, burst=1, drop_after=None):
+        self.sock = sock
+        self.rate = rate
+        self.reports = reports if reports is not None else synthetic_reports()
+        self.burst = burst
+        self.drop_after = drop_after
+        # Output reports from the host, not checked against the input ones
+        self.parser = zl.ZcpParser(resync=False)
+        self.thread = None
+
+        # State of the simulated device
+        self.idle = 0
+        self.disabled = set()
+        self.raw = set()
+        self.name = b"Zeemote JS1"
+        self.keep_alive_interval = 0
+        # Answers to GET_REPORT
+        self.info = {
+            0x03: [zl.FirmwareReport(0x03, 1, 2, 3, 4, 5, b"Zeemote JS1")],
+            0x04: [zl.ButtonDescriptionReport(0x04, button, button, b"Button " + b"ABCD"[button:button + 1])
+                   for button in range(4)],
+            0x1B: [zl.ProtocolVersionReport(0x1B, 1, 2, 0)],
+        }
+
+        self.sent = 0
+        self.commands = 0
+
+    def handle(self, frame):
+        """Answer an output report with a handshake."""
+        self.commands += 1
+        header = ord(frame[1:2]) if len(frame) > 1 else None
+        report_id = ord(frame[2:3]) if len(frame) > 2 else None
+        code = SUCCESSFUL
+
+        if header == 0x90:
+            # SET_IDLE
+            if len(frame) == 3:
+                self.idle = report_id
+            else:
+                code = ERR_INVALID_PARAMETER
+        elif header == 0xA2:
+            # DATA | Output
+            if report_id == 0x06 and len(frame) == 5:
+                target, flags = struct.unpack("BB", frame[3:5])
+                if flags & 1:
+                    self.disabled.discard(target)
+                else:
+                    self.disabled.add(target)
+                if flags & 2:
+                    self.raw.add(target)
+                else:
+                    self.raw.discard(target)
+            elif report_id == 0x18 and len(frame) == 36:
+                length = ord(frame[3:4])
+                self.name = frame[4:4 + length]
+            elif report_id == 0x19 and len(frame) == 5:
+                self.keep_alive_interval = struct.unpack(">H", frame[3:5])[0]
+            elif report_id in (0x06, 0x18, 0x19):
+                code = ERR_INVALID_PARAMETER
+            else:
+                code = ERR_INVALID_REPORT_ID
+        elif header == 0x41:
+            # GET_REPORT | Input: no handshake unless it fails
+            if report_id in self.info and len(frame) == 3:
+                self.sock.sendall(b"".join(zl.encode_report(report) for report in self.info[report_id]))
+                return
+            code = ERR_INVALID_REPORT_ID
+        else:
+            code = ERR_UNSUPPORTED_REQUEST
+
+        self.sock.sendall(b"\x01" + code)
+
+    def next_frames(self):
+        """Encode the next burst of enabled reports.  Fewer of them, or
+        none, are returned when most of the stream is disabled."""
+        frames = []
+        # Bounded: every report of the stream can be disabled
+        for i in range(self.burst * 16):
+            if len(frames) == self.burst:
+                break
+            report = next(self.reports)
+            if report.report_id in self.disabled:
+                continue
+            if report.report_id in self.raw and hasattr(report, "raw"):
+                report = report._replace(raw=1)
+            frames.append(zl.encode_report(report))
+        return frames
+
+    def run(self, count=None, duration=None):
+        """Serve the host until count reports are sent, duration elapsed
+        or the connection is closed."""
+        interval = float(self.burst) / self.rate if self.rate else 0
+        start = time.time()
+        next_time = start
+        try:
+            while count is None or self.sent < count:
+                now = time.time()
+                if duration is not None and now - start >= duration:
+                    break
+
+                readable = select.select([self.sock], [], [], max(0, next_time - now))[0]
+                if readable:
+                    n = self.sock.recv_into(self.parser.writable())
+                    if n == 0:
+                        # The host is gone
+                        break
+                    self.parser.written(n)
+                    frame = self.parser.next_frame()
+                    while frame is not None:
+                        self.handle(frame)
+                        frame = self.parser.next_frame()
+                    continue
+
+                frames = self.next_frames()
+                if not frames:
+                    # Everything is disabled: wait for the host to enable
+                    # some reports
+                    next_time = now + max(interval, 0.1)
+                    continue
+                self.sock.sendall(b"".join(frames))
+                self.sent += len(frames)
+                next_time += interval
+                if self.drop_after is not None and self.sent >= self.drop_after:
+                    break
+        except socket.error:
+            pass
+        finally:
+            self.sock.close()
+
+    def start(self, **kwargs):
+        """Run the simulator in a background thread."""
+        self.thread = threading.Thread(target=self.run, kwargs=kwargs)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.thread
+
+    # End of the class ZcpSimulator
+
+
+def simulated_transport(**kwargs):
+    """Return a transport connected to a simulator running in a thread."""
+    transport, sock = zl.SocketTransport.pair()
+    simulator = ZcpSimulator(sock, **kwargs)
+    simulator.start()
+    return transport, simulator
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a Zeemote device")
+    where = parser.add_mutually_exclusive_group(required=True)
+    where.add_argument("--tcp", metavar="HOST:PORT", help="listen on a TCP port")
+    where.add_argument("--unix", metavar="PATH", help="listen on a Unix socket")
+    parser.add_argument("--rate", type=float, default=100.0,
+                        help="reports per second, 0 for as fast as possible")
+    parser.add_argument("--burst", type=int, default=1, help="reports per send")
+    parser.add_argument("--count", type=int, help="reports per connection")
+    parser.add_argument("--drop-after", type=int,
+                        help="close each connection after that many reports")
+    parser.add_argument("--seed", type=int, help="seed of the synthetic reports")
+    args = parser.parse_args()
+
+    if args.tcp:
+        host, port = args.tcp.rsplit(":", 1)
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, int(port)))
+    else:
+        if os.path.exists(args.unix):
+            os.unlink(args.unix)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(args.unix)
+    server.listen(1)
+
+    # One host at a time, so that it can reconnect
+    while True:
+        sock, peer = server.accept()
+        print("Host connected", peer)
+        simulator = ZcpSimulator(sock, args.rate, synthetic_reports(args.seed),
+                                 args.burst, args.drop_after)
+        simulator.run(args.count)
+        print("Host disconnected after %d reports" % simulator.sent)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/python
+
+# 
+# LICENSE
+# 
+# Copyright (c) 2010, University College Dublin, National University of
+# Ireland, Dublin
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# - Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# 
+# - Neither the name University College Dublin, National University of
+# Ireland, Dublin nor the names of its contributors may be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# Supervisor owning the connection to a Zeemote: the link is opened again
+# in the background, with an exponential backoff, whenever it is lost
+#
+
+from __future__ import print_function
+
+import threading
+
+import zeemote_listener as zl
+
+# Connection states
+CONNECTING   = "connecting"
+CONNECTED    = "connected"
+DISCONNECTED = "disconnected"
+CLOSED       = "closed"
+
+
+class ZeemoteSupervisor():
+    """Keep a ZeemoteControl connected.
+
+    start() connects in a background thread.  When the link is lost, the
+    thread tries to connect again after min_delay seconds, doubling the
+    delay after each failure up to max_delay; ZeemoteControl.connect()
+    sends the configuration of the device (idle time, report profile...)
+    again once connected.
+    Meanwhile listen() only waits for its timeout, and the callbacks given
+    to on_state() are called with each new state:
+
+        supervisor = ZeemoteSupervisor()
+        supervisor.on_state(lambda state: print("Zeemote", state))
+        supervisor.start()
+        while True:
+            report = supervisor.listen(timeout=0.1)
+            ...
+
+    Instead of an RFCOMM address, transport can be a callable returning
+    a connected transport (see zeemote_transport.py), called for each
+    attempt, for instance to keep a simulator connected:
+
+        ZeemoteSupervisor(transport=lambda: SocketTransport.unix(path))
+    """
+    def __init__(self, zeemote=None, address=None, port=None, tries_nb=3, min_delay=0.5, max_delay=30.0,
+                 transport=None):
+        self.zeemote = zeemote or zl.ZeemoteControl(tries_nb)
+        self.address = address
+        self.port = port
+        # Callable returning a connected transport, used instead of address
+        self.transport = transport
+        # SDP tries of each connection attempt
+        self.number_of_tries = tries_nb
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+        self.state = DISCONNECTED
+        self.connections = 0
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.thread = None
+        self.connected = threading.Event()
+        self.stopped = threading.Event()
+
+    def on_state(self, callback):
+        self.callbacks.append(callback)
+
+    def set_state(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        zl.log.info("Zeemote %s", state)
+        for callback in self.callbacks:
+            try:
+                callback(state)
+            except Exception:
+                zl.log.exception("State callback failed")
+
+    def start(self):
+        """Connect in the background, return at once."""
+        with self.lock:
+            if self.stopped.is_set() or (self.thread is not None and self.thread.is_alive()):
+                return
+            self.thread = threading.Thread(target=self.run, name="zeemote-supervisor")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        delay = self.min_delay
+        while not self.stopped.is_set():
+            self.set_state(CONNECTING)
+            if self.try_connect():
+                self.set_state(CONNECTED)
+                self.connected.set()
+                return
+            self.set_state(DISCONNECTED)
+            if zl.debug:
+                print("Connecting again in %.1f s" % delay)
+            self.stopped.wait(delay)
+            delay = min(delay * 2, self.max_delay)
+
+    def try_connect(self):
+        zeemote = self.zeemote
+        # A fresh budget for each attempt, rather than the shared counter
+        zeemote.number_of_tries = self.number_of_tries
+        try:
+            if self.transport is not None:
+                zeemote.connect(transport=self.transport())
+            else:
+                zeemote.connect(self.address, self.port)
+            if not zeemote.connected:
+                return False
+        except Exception as e:
+            zl.log.warning("Connection failed: %s", e)
+            if zeemote.connected:
+                zeemote.close_transport()
+            return False
+
+        if self.address is None:
+            # Stick to the device found by the first connection
+            self.address = zeemote.address
+        self.connections += 1
+        if self.connections > 1:
+            zeemote.stats.reconnects += 1
+        return True
+
+    def link_lost(self):
+        self.connected.clear()
+        self.zeemote.stats.link_errors += 1
+        self.zeemote.close_transport()
+        if not self.stopped.is_set():
+            self.set_state(DISCONNECTED)
+            self.start()
+
+    def listen(self, timeout=None):
+        """Return the next report, or None after timeout seconds (never
+        if None) without one, connected or not."""
+        deadline = None if timeout is None else zl.timer() + timeout
+        while not self.stopped.is_set():
+            if not self.connected.wait(remaining(deadline)):
+                return None
+            if self.zeemote.backlog:
+                return self.zeemote.backlog.popleft()
+            reader = self.zeemote.reader
+            try:
+                frame = reader.next_frame()
+                if frame is None:
+                    if not reader.wait(remaining(deadline)):
+                        return None
+                    reader.fill()
+                    continue
+            except zl.BluetoothError:
+                self.link_lost()
+                continue
+            return self.zeemote.process_frame(frame)
+        return None
+
+    def __iter__(self):
+        while not self.stopped.is_set():
+            report = self.listen(0.5)
+            if report is not None:
+                yield report
+
+    def close(self):
+        self.stopped.set()
+        self.connected.clear()
+        if self.thread is not None:
+            self.thread.join()
+        self.zeemote.disconnect()
+        self.set_state(CLOSED)
+
+    # End of the class ZeemoteSupervisor
+
+
+def remaining(deadline):
+    if deadline is None:
+        return None
+    return max(0.0, deadline - zl.timer())
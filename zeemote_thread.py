@@ -0,0 +1,199 @@
+#!/usr/bin/python
+
+# 
+# LICENSE
+# 
+# Copyright (c) 2010, University College Dublin, National University of
+# Ireland, Dublin
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# - Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# 
+# - Neither the name University College Dublin, National University of
+# Ireland, Dublin nor the names of its contributors may be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# Reader thread: the socket is read and the reports decoded in the
+# background, the application gets them from a deque and a file
+# descriptor to watch from its main loop
+#
+
+from __future__ import print_function
+
+import errno
+import fcntl
+import os
+import select
+import threading
+from collections import deque
+
+import zeemote_listener as zl
+
+
+class ReaderThread():
+    """Read a connected ZeemoteControl from a dedicated thread.
+
+    The reports are appended to a deque (at most maxlen of them, the
+    oldest being dropped), and a byte is written to a pipe when the deque
+    stops being empty.  fileno() can be registered with select() or any
+    main loop, for instance with glib:
+
+        reader = ReaderThread(zeemote)
+        reader.start()
+        GLib.io_add_watch(reader.fileno(), GLib.IO_IN, on_input)
+
+        def on_input(fd, condition):
+            for report in reader.poll():
+                ...
+            return True
+
+    poll() never blocks, listen() waits at most its timeout.  Commands can
+    still be sent from the application thread: their handshakes are
+    matched by the reader thread.
+    """
+    def __init__(self, zeemote, maxlen=4096):
+        self.zeemote = zeemote
+        self.reports = deque(maxlen=maxlen)
+        self.dropped = 0
+        self.thread = None
+        self.running = False
+
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        # True while a byte is waiting in the pipe
+        self.signalled = False
+
+    def fileno(self):
+        return self.wakeup_r
+
+    def start(self):
+        self.running = True
+        self.zeemote.reader_thread = self
+        self.thread = threading.Thread(target=self.run, name="zeemote-reader")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.read_reports()
+        finally:
+            self.running = False
+            # Wake up the consumer for the end of the stream
+            self.signal()
+
+    def read_reports(self):
+        zeemote = self.zeemote
+        reports = self.reports
+        while self.running and zeemote.connected:
+            reader = zeemote.reader
+            try:
+                if not reader.wait(0.2):
+                    continue
+                reader.fill()
+            except zl.BluetoothError:
+                try:
+                    zeemote.link_lost()
+                except Exception:
+                    # No device to reconnect to
+                    zl.log.exception("Reconnection failed")
+                    break
+                if not zeemote.connected:
+                    # Not reconnected: the stream ends here
+                    break
+                continue
+            except (ValueError, select.error):
+                # Socket closed by disconnect() from another thread
+                break
+
+            frame = reader.next_frame()
+            while frame is not None:
+                if len(reports) == reports.maxlen:
+                    self.dropped += 1
+                reports.append(zeemote.process_frame(frame))
+                frame = reader.next_frame()
+            if reports:
+                self.signal()
+
+    def signal(self):
+        if not self.signalled:
+            self.signalled = True
+            try:
+                os.write(self.wakeup_w, b"\x00")
+            except OSError:
+                pass
+
+    def clear(self):
+        # Drain the pipe before resetting the flag: a report appended in
+        # between is seen by the caller, which reads the deque afterwards
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        self.signalled = False
+
+    def poll(self):
+        """Return every report received so far, without blocking."""
+        self.clear()
+        reports = self.reports
+        result = []
+        while reports:
+            result.append(reports.popleft())
+        return result
+
+    def listen(self, timeout=None):
+        """Return the next report, or None after timeout seconds (never
+        if None) or once the reader has stopped."""
+        deadline = None if timeout is None else zl.timer() + timeout
+        while True:
+            if self.reports:
+                return self.reports.popleft()
+            if not self.running:
+                return None
+            remaining = None if deadline is None else deadline - zl.timer()
+            if remaining is not None and remaining <= 0:
+                return None
+            select.select([self.wakeup_r], [], [], remaining)
+            self.clear()
+
+    def stop(self):
+        """Stop the thread; the ZeemoteControl stays connected."""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.zeemote.reader_thread = None
+
+    def close(self):
+        self.stop()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+    # End of the class ReaderThread
@@ -0,0 +1,187 @@
+#!/usr/bin/python
+
+# 
+# LICENSE
+# 
+# Copyright (c) 2010, University College Dublin, National University of
+# Ireland, Dublin
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# - Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# 
+# - Neither the name University College Dublin, National University of
+# Ireland, Dublin nor the names of its contributors may be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# Byte streams to Zeemote devices: Bluetooth RFCOMM, plain sockets (to a
+# simulator for instance) and files
+#
+
+import socket
+
+try:
+    from bluetooth import BluetoothSocket, BluetoothError, RFCOMM, find_service
+except ImportError:
+    # Without PyBluez, only the non-Bluetooth transports are available
+    BluetoothSocket = None
+    RFCOMM = None
+
+    class BluetoothError(IOError):
+        pass
+
+    def find_service(**kwargs):
+        raise BluetoothError("PyBluez is not installed")
+
+
+class Transport():
+    """Connected byte stream to a Zeemote device.
+
+    Transports have the socket methods used by the library: recv_into(),
+    recv(), send(), fileno() and close().  A lost link is always reported
+    with BluetoothError, whatever the transport.
+    """
+    def recv_into(self, buf):
+        data = self.recv(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def recv(self, size):
+        raise NotImplementedError
+
+    def send(self, data):
+        raise NotImplementedError
+
+    def fileno(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    # End of the class Transport
+
+
+class SocketTransport(Transport):
+    """Any connected stream socket: TCP, Unix, socketpair()..."""
+    def __init__(self, sock):
+        self.sock = sock
+
+    @classmethod
+    def tcp(cls, host, port):
+        return cls(socket.create_connection((host, port)))
+
+    @classmethod
+    def unix(cls, path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except:
+            sock.close()
+            raise
+        return cls(sock)
+
+    @classmethod
+    def pair(cls):
+        """Return a transport and the socket of the device side."""
+        ours, theirs = socket.socketpair()
+        return cls(ours), theirs
+
+    def recv_into(self, buf):
+        try:
+            return self.sock.recv_into(buf)
+        except socket.error as e:
+            raise BluetoothError(str(e))
+
+    def recv(self, size):
+        try:
+            return self.sock.recv(size)
+        except socket.error as e:
+            raise BluetoothError(str(e))
+
+    def send(self, data):
+        try:
+            return self.sock.send(data)
+        except socket.error as e:
+            raise BluetoothError(str(e))
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+    # End of the class SocketTransport
+
+
+class RfcommTransport(SocketTransport):
+    """Bluetooth RFCOMM connection, the way Zeemote devices talk."""
+    def __init__(self, address, port):
+        if BluetoothSocket is None:
+            raise BluetoothError("PyBluez is not installed")
+        sock = BluetoothSocket( RFCOMM )
+        try:
+            sock.connect((address, port))
+        except:
+            sock.close()
+            raise
+        SocketTransport.__init__(self, sock)
+
+    def recv_into(self, buf):
+        # Some Bluetooth sockets have no recv_into()
+        if not hasattr(self.sock, "recv_into"):
+            return Transport.recv_into(self, buf)
+        return SocketTransport.recv_into(self, buf)
+
+    # End of the class RfcommTransport
+
+
+class FileTransport(Transport):
+    """Read a recorded ZCP input stream from a file.
+
+    What is sent to the device is written to output, if given, or dropped.
+    The end of the file is seen as a closed connection.
+    """
+    def __init__(self, input, output=None):
+        if isinstance(input, str):
+            input = open(input, "rb")
+        self.input = input
+        self.output = output
+
+    def recv(self, size):
+        return self.input.read(size)
+
+    def send(self, data):
+        if self.output is not None:
+            self.output.write(data)
+        return len(data)
+
+    def fileno(self):
+        return self.input.fileno()
+
+    def close(self):
+        self.input.close()
+
+    # End of the class FileTransport
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+
+# 
+# LICENSE
+# 
+# Copyright (c) 2010, University College Dublin, National University of
+# Ireland, Dublin
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# - Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# 
+# - Neither the name University College Dublin, National University of
+# Ireland, Dublin nor the names of its contributors may be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+
+#
+# zeemoted: owns the connections to the Zeemote controllers and shares
+# their reports with any number of local clients over a Unix socket
+#
+# Wire format, server to client: messages of a type byte and a device
+# number byte, followed by
+#   MSG_REPORT  the ZCP frame of the report (length byte included)
+#   MSG_DEVICE  a length byte and the address of a new device
+#   MSG_GONE    nothing, the device is disconnected
+# Client to server: an opcode byte, a length byte and length bytes of
+# arguments.  OP_FILTER takes the report IDs the client wants (all of
+# them when there is none), OP_INFO no argument.  Both are answered with
+# the device information reports known so far which pass the filter.
+#
+
+from __future__ import print_function
+
+import argparse
+import errno
+import os
+import socket
+import struct
+import time
+
+import zeemote_listener as zl
+from zeemote_hub import ZeemoteHub, selectors
+
+DEFAULT_SOCKET = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or "/tmp", "zeemoted.sock")
+
+MSG_REPORT = 0
+MSG_DEVICE = 1
+MSG_GONE   = 2
+
+OP_FILTER = 1
+OP_INFO   = 2
+
+# Device information, sent from the cache to new clients
+INFO_REPORTS = (0x03, 0x04, 0x1B)
+
+
+class Client():
+    """A connected client: its filter and its bounded output buffer."""
+    def __init__(self, sock, maxsize):
+        self.sock = sock
+        self.maxsize = maxsize
+        # Report IDs wanted, None for all
+        self.filter = None
+        self.inbuf = b""
+        self.outbuf = bytearray()
+        self.dropped = 0
+        # The device information is to be sent, through the filter
+        self.info_requested = False
+
+    def wants(self, report_id):
+        return self.filter is None or report_id in self.filter
+
+    def queue(self, msg):
+        """Buffer msg, or drop it when the client is too slow."""
+        if len(self.outbuf) + len(msg) > self.maxsize:
+            self.dropped += 1
+            return False
+        self.outbuf += msg
+        return True
+
+    def flush(self):
+        """Send as much as possible without blocking, return False if the
+        client is gone."""
+        if self.outbuf:
+            try:
+                n = self.sock.send(self.outbuf)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return True
+                return False
+            del self.outbuf[:n]
+        return True
+
+    def receive(self):
+        """Read the requests of the client, return False if it is gone."""
+        try:
+            data = self.sock.recv(4096)
+        except socket.error as e:
+            return e.errno in (errno.EAGAIN, errno.EWOULDBLOCK)
+        if not data:
+            return False
+        self.inbuf += data
+        while len(self.inbuf) >= 2:
+            op, length = struct.unpack("BB", self.inbuf[:2])
+            if len(self.inbuf) < 2 + length:
+                break
+            args = bytearray(self.inbuf[2:2 + length])
+            self.inbuf = self.inbuf[2 + length:]
+            if op == OP_FILTER:
+                self.filter = frozenset(args) if args else None
+                self.info_requested = True
+            elif op == OP_INFO:
+                self.info_requested = True
+        return True
+
+    # End of the class Client
+
+
+class ZeemoteDaemon():
+    """Serve the reports of the devices of a ZeemoteHub to local clients.
+
+    Reports are decoded once, and encoded once per report for all the
+    clients.  Each client has its own filter and output buffer: the
+    messages for a client whose buffer is full are dropped, so a slow
+    client doesn't hold the others back.  The device information reports
+    are kept, and sent to the clients connecting later once they have set
+    their filter (or asked for them with OP_INFO).
+    """
+    def __init__(self, path=DEFAULT_SOCKET, hub=None, maxsize=64 * 1024, retry=10.0):
+        self.path = path
+        self.hub = hub or ZeemoteHub()
+        self.selector = self.hub.selector
+        self.maxsize = maxsize
+        self.retry = retry
+        self.clients = {}
+        # address -> device number
+        self.numbers = {}
+        # address -> {(report_id, button_id): message}
+        self.info = {}
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(16)
+        self.server.setblocking(False)
+        self.selector.register(self.server, selectors.EVENT_READ, self)
+
+    def number(self, address):
+        if address not in self.numbers:
+            self.numbers[address] = len(self.numbers) & 0xFF
+        return self.numbers[address]
+
+    def device_message(self, address):
+        name = str(address).encode("utf-8")[:255]
+        return struct.pack("BBB", MSG_DEVICE, self.number(address), len(name)) + name
+
+    def add_device(self, zeemote):
+        self.hub.add(zeemote)
+        self.broadcast(self.device_message(zeemote.address))
+        self.load_info(zeemote)
+
+    def connect(self):
+        """Connect the devices of the hub not connected yet, and announce
+        them; return the number of devices."""
+        known = set(self.hub.devices)
+        count = self.hub.connect()
+        for address in set(self.hub.devices) - known:
+            self.broadcast(self.device_message(address))
+            self.load_info(self.hub.devices[address])
+        return count
+
+    def load_info(self, zeemote):
+        """Ask a new device for its information, kept for the clients."""
+        try:
+            info = zeemote.device_info()
+        except (zl.HandshakeTimeout, zl.HandshakeError, zl.BluetoothError) as e:
+            zl.log.warning("No information from %s: %s", zeemote.address, e)
+            return
+        for report in info.reports():
+            self.publish(zeemote.address, report)
+
+    def broadcast(self, msg, report_id=None):
+        for client in self.clients.values():
+            if report_id is None or client.wants(report_id):
+                client.queue(msg)
+
+    def publish(self, address, report):
+        msg = struct.pack("BB", MSG_REPORT, self.number(address)) + zl.encode_report(report)
+        if report.report_id in INFO_REPORTS:
+            key = (report.report_id, getattr(report, "button_id", None))
+            self.info.setdefault(address, {})[key] = msg
+        self.broadcast(msg, report.report_id)
+
+    def accept(self):
+        try:
+            sock, peer = self.server.accept()
+        except socket.error:
+            return
+        sock.setblocking(False)
+        client = Client(sock, self.maxsize)
+        self.clients[sock.fileno()] = client
+        self.selector.register(sock, selectors.EVENT_READ, client)
+        # The device information waits for the filter of the client
+        for address in self.hub.devices:
+            client.queue(self.device_message(address))
+
+    def send_info(self, client):
+        """Queue the device information reports the client wants."""
+        client.info_requested = False
+        for address in self.hub.devices:
+            for (report_id, button_id), msg in self.info.get(address, {}).items():
+                if client.wants(report_id):
+                    client.queue(msg)
+
+    def drop(self, client):
+        self.selector.unregister(client.sock)
+        del self.clients[client.sock.fileno()]
+        client.sock.close()
+
+    def step(self, timeout=None):
+        """Serve once whatever is ready."""
+        for key, mask in self.selector.select(timeout):
+            data = key.data
+            if data is self:
+                self.accept()
+            elif isinstance(data, Client):
+                if mask & selectors.EVENT_READ and not data.receive():
+                    self.drop(data)
+                elif data.info_requested:
+                    self.send_info(data)
+                elif mask & selectors.EVENT_WRITE and not data.flush():
+                    self.drop(data)
+            else:
+                address = data.address
+                reports = self.hub.read(data)
+                if reports is None:
+                    self.broadcast(struct.pack("BB", MSG_GONE, self.number(address)))
+                    continue
+                for report in reports:
+                    self.publish(address, report)
+
+        for client in list(self.clients.values()):
+            if not client.flush():
+                self.drop(client)
+                continue
+            # Only wait for the socket to be writable while data is pending
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outbuf else 0)
+            if self.selector.get_key(client.sock).events != events:
+                self.selector.modify(client.sock, events, client)
+
+    def serve_forever(self):
+        last_try = time.time()
+        while True:
+            self.step(self.retry)
+            missing = self.hub.addresses and len(self.hub.devices) < len(self.hub.addresses)
+            if missing and time.time() - last_try >= self.retry:
+                last_try = time.time()
+                self.connect()
+
+    def close(self):
+        for client in list(self.clients.values()):
+            self.drop(client)
+        self.selector.unregister(self.server)
+        self.server.close()
+        os.unlink(self.path)
+        self.hub.disconnect()
+
+    # End of the class ZeemoteDaemon
+
+
+class DaemonClient():
+    """Client side of zeemoted:
+
+        client = DaemonClient()
+        client.set_filter([0x07, 0x08])
+        while True:
+            address, report = client.read()
+            ...
+
+    read() returns (address, None) when a device is gone.  The device
+    information reports known by the daemon come after set_filter(), or
+    request_info() for a client keeping every report.
+    """
+    def __init__(self, path=DEFAULT_SOCKET):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.buf = b""
+        # device number -> address
+        self.devices = {}
+
+    def set_filter(self, report_ids=()):
+        ids = bytearray(report_ids)
+        self.sock.sendall(struct.pack("BB", OP_FILTER, len(ids)) + bytes(ids))
+
+    def request_info(self):
+        self.sock.sendall(struct.pack("BB", OP_INFO, 0))
+
+    def recv_exactly(self, n):
+        while len(self.buf) < n:
+            data = self.sock.recv(4096)
+            if not data:
+                raise EOFError("zeemoted closed the connection")
+            self.buf += data
+        data, self.buf = self.buf[:n], self.buf[n:]
+        return data
+
+    def read(self):
+        while True:
+            msg_type, device = struct.unpack("BB", self.recv_exactly(2))
+            if msg_type == MSG_GONE:
+                return self.devices.pop(device, None), None
+            length = self.recv_exactly(1)
+            data = self.recv_exactly(ord(length))
+            if msg_type == MSG_REPORT:
+                return self.devices.get(device), zl.decode_report(length + data)
+            elif msg_type == MSG_DEVICE:
+                self.devices[device] = data.decode("utf-8")
+
+    def close(self):
+        self.sock.close()
+
+    # End of the class DaemonClient
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Share Zeemote controllers with local clients")
+    parser.add_argument("addresses", nargs="*", help="devices to use, all found if none")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="path of the Unix socket")
+    parser.add_argument("--buffer", type=int, default=64 * 1024,
+                        help="output buffer of each client, in bytes")
+    parser.add_argument("--simulator", metavar="PATH",
+                        help="use the zeemote_simulator.py listening on this Unix socket")
+    args = parser.parse_args()
+
+    hub = ZeemoteHub(args.addresses or None)
+    daemon = ZeemoteDaemon(args.socket, hub, args.buffer)
+    if args.simulator:
+        zeemote = zl.ZeemoteControl(cache=False)
+        zeemote.connect(transport=zl.SocketTransport.unix(args.simulator))
+        zeemote.address = args.simulator
+        daemon.add_device(zeemote)
+    elif daemon.connect() == 0:
+        print("No Zeemote device")
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+
+
+if __name__ == "__main__":
+    main()